@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Simon Guest
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+# Analyse and replay shifter traces, recorded by running qlsync with
+# QLSYNC_TRACE_DIR set in the environment.
+#
+#   summary TRACE       per-method counts, time and bytes of a trace
+#   shifter TRACE       drive the recorded call sequence against another
+#                       shifter, and compare timings and results
+#   planner SCAN [SYNC] rerun the current scan (and sync) code offline
+#                       against the recorded device, and compare the calls
+#                       it makes with those recorded
+#
+# Run from the top of the source tree; results are printed as JSON.
+
+import argparse
+import copy
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.getcwd())
+
+def method_summary(calls):
+    """Return per-method count, failures, seconds and bytes of recorded calls."""
+    methods = {}
+    for record in calls:
+        stats = methods.setdefault(record["m"], {"count": 0, "failures": 0, "seconds": 0.0, "bytes": 0})
+        stats["count"] += 1
+        stats["seconds"] += record["d"]
+        if "e" in record:
+            stats["failures"] += 1
+        stats["bytes"] += sum([size for size in record.get("z", []) if size])
+    return methods
+
+def summary(args):
+    from qlsync.trace import read_trace
+    header, calls = read_trace(args.trace)
+    return {
+        "header": header,
+        "calls": len(calls),
+        "sessions": len(set([record["s"] for record in calls])),
+        "elapsed": max([record["t"] + record["d"] for record in calls] or [0.0]),
+        "methods": method_summary(calls),
+    }
+
+class PathMap(object):
+    """Rewrite device path prefixes given as OLD=NEW."""
+
+    def __init__(self, mappings):
+        self.mappings = [mapping.split("=", 1) for mapping in mappings]
+
+    def __call__(self, x):
+        if isinstance(x, str):
+            for old, new in self.mappings:
+                if x.startswith(old):
+                    return new + x[len(old):]
+        elif isinstance(x, list):
+            return [self(y) for y in x]
+        return x
+
+class Sources(object):
+    """Local upload sources, made up to the recorded size where the originals are gone."""
+
+    def __init__(self, tmpdir):
+        self.tmpdir = tmpdir
+        self.made = {}                   # indexed by size, of path
+
+    def __call__(self, src, size):
+        if os.path.exists(src) or size is None:
+            return src
+        path = self.made.get(size)
+        if path is None:
+            path = os.path.join(self.tmpdir, "source-%d" % size)
+            with open(path, 'wb') as f:
+                f.write("\0" * size)
+            self.made[size] = path
+        return path
+
+def target_shifter(args):
+    from qlsync.shifters import FilesystemShifter, MemoryShifter
+    if args.target == 'memory':
+        return MemoryShifter(latency = args.latency, bandwidth = args.bandwidth, batching = not args.no_batching)
+    else:
+        return FilesystemShifter()
+
+def replay_args(record, path_map, sources):
+    """Return the arguments of a recorded call, for replaying."""
+    method = record["m"]
+    call_args = path_map(record["a"])
+    sizes = record.get("z")
+    if method == 'uploadfile':
+        call_args[0] = sources(record["a"][0], sizes[0])
+    elif method == 'uploadfiles':
+        call_args[0] = [(sources(src, size), dst) for (src, dst), size in zip(call_args[0], sizes)]
+    return call_args
+
+def shifter(args):
+    """Drive the recorded calls in order against the target shifter, one session per recorded session."""
+    from qlsync.shifters import ShifterError
+    from qlsync.trace import encode, read_trace
+    header, calls = read_trace(args.trace)
+    path_map = PathMap(args.map)
+    tmpdir = tempfile.mkdtemp(prefix = "qlsync-replay-")
+    try:
+        sources = Sources(tmpdir)
+        base = target_shifter(args)
+        sessions = {}                    # indexed by recorded session, of shifter
+        methods = {}
+        mismatches = []
+        t_start = time.time()
+        for record in calls:
+            method = record["m"]
+            session = sessions.get(record["s"])
+            if session is None:
+                session = copy.copy(base)
+                sessions[record["s"]] = session
+            t0 = time.time()
+            try:
+                result = getattr(session, method)(*replay_args(record, path_map, sources))
+                error = None
+            except ShifterError as e:
+                result = None
+                error = str(e)
+            elapsed = time.time() - t0
+            stats = methods.setdefault(method, {"count": 0, "recorded_seconds": 0.0, "replayed_seconds": 0.0, "failures": 0})
+            stats["count"] += 1
+            stats["recorded_seconds"] += record["d"]
+            stats["replayed_seconds"] += elapsed
+            if error is not None:
+                stats["failures"] += 1
+            if ("e" in record) != (error is not None) or \
+               (error is None and "r" in record and encode(result) != path_map(encode(record["r"]))):
+                mismatches.append({"method": method, "args": record["a"], "recorded": record.get("e", record.get("r")),
+                                   "replayed": error if error is not None else encode(result)})
+        results = {
+            "target": args.target,
+            "calls": len(calls),
+            "recorded_seconds": sum([method_stats["recorded_seconds"] for method_stats in methods.values()]),
+            "replayed_seconds": time.time() - t_start,
+            "methods": methods,
+            "mismatches": len(mismatches),
+            "first_mismatches": mismatches[:args.show_mismatches],
+        }
+        if args.target == 'memory':
+            results["simulated"] = base.device.stats()
+        return results
+    finally:
+        shutil.rmtree(tmpdir, True)
+
+def compare_calls(recorded, replayed):
+    """Return per-method recorded and replayed call counts."""
+    return dict([(method, {"recorded": recorded.get(method, {}).get("count", 0), "replayed": replayed.get(method, 0)})
+                 for method in set(recorded.keys()) | set(replayed.keys())])
+
+def used_state_cache(calls):
+    """Return whether a recorded scan took its playlists from the local state cache, and so never read them."""
+    # the cache is only used when the manifest has an mtime, and the playlist dir is then listed unless it was used
+    manifest_mtimes = [record for record in calls if record["m"] == 'getmtimes' and record.get("r") and record["r"][-1] is not None]
+    listings = [record for record in calls if record["m"] == 'ls']
+    return bool(manifest_mtimes) and not listings
+
+def planner(args):
+    """Rerun scan and sync with the current code against the recorded device."""
+    from qlsync.engine import Device, Library, Syncer
+    from qlsync.trace import ReplayShifter, read_trace
+    scan_header, scan_calls = read_trace(args.scan)
+    if used_state_cache(scan_calls):
+        raise SystemExit("%s is a scan which used the local state cache, so it has no playlists to replay; "
+                         "record it again with the current code, which doesn't use the cache when tracing" % args.scan)
+    replay = ReplayShifter(scan_calls)
+    if args.musicdir or args.playlist_dir:
+        library = Library(args.musicdir, args.playlist_dir)
+    else:
+        library = Library()
+    syncer = Syncer(library)
+    device = Device(scan_header["device"], scan_header["musicdir"], replay,
+                    flatten = scan_header["flatten"], connections = scan_header["connections"])
+    results = {}
+    t0 = time.time()
+    syncer.scan_device(device, scan_header.get("inventory", False))
+    results["scan"] = {
+        "seconds": time.time() - t0,
+        "calls": compare_calls(method_summary(scan_calls), replay.calls),
+        "unmatched": replay.unmatched,
+    }
+    if args.sync:
+        sync_header, sync_calls = read_trace(args.sync)
+        replay = ReplayShifter(sync_calls)
+        device.shifter = replay
+        wanted = set(sync_header["playlists"])
+        missing = wanted - set(syncer.playlists)
+        labels = []
+        done = {}
+        def progress(fraction, complete = False, stats = None):
+            if complete:
+                done.update(stats or {})
+        t0 = time.time()
+        scribe = syncer.sync_device(device, [playlist in wanted for playlist in syncer.playlists], labels.append, progress,
+                                    verify = sync_header.get("verify", False))
+        scribe.join()
+        syncer.sync_device_completed(1, device)
+        results["sync"] = {
+            "seconds": time.time() - t0,
+            "calls": compare_calls(method_summary(sync_calls), replay.calls),
+            "unmatched": replay.unmatched,
+            "playlists_missing_from_library": sorted(missing),
+            "files": done.get("files_done", 0),
+            "deletions": done.get("deletions_done", 0),
+        }
+        if labels and labels[-1].startswith("sync failed"):
+            results["sync"]["error"] = labels[-1]
+    syncer.cleanup()
+    return results
+
+class Quiet(object):
+    """Discard qlsync's chatter on stdout for the duration."""
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+
+    p = subparsers.add_parser("summary", help = "summarise a trace")
+    p.add_argument("trace")
+    p.set_defaults(func = summary)
+
+    p = subparsers.add_parser("shifter", help = "replay a trace against another shifter")
+    p.add_argument("trace")
+    p.add_argument("--target", choices = ['memory', 'filesystem'], default = 'memory')
+    p.add_argument("--map", action = 'append', default = [], metavar = "OLD=NEW", help = "rewrite device path prefix OLD as NEW")
+    p.add_argument("--latency", type = float, default = 0.0, help = "simulated seconds per round trip, for memory")
+    p.add_argument("--bandwidth", type = float, help = "simulated bytes per second, for memory")
+    p.add_argument("--no-batching", action = 'store_true', help = "one round trip per item, for memory")
+    p.add_argument("--show-mismatches", type = int, default = 10, help = "how many mismatched results to show")
+    p.set_defaults(func = shifter)
+
+    p = subparsers.add_parser("planner", help = "rerun scan and sync against a recorded device")
+    p.add_argument("scan", help = "scan trace")
+    p.add_argument("sync", nargs = '?', help = "sync trace, recorded after the scan")
+    p.add_argument("--musicdir", action = 'append', help = "library music dir, instead of Quod Libet's")
+    p.add_argument("--playlist-dir", help = "library playlist dir, instead of Quod Libet's")
+    p.set_defaults(func = planner)
+
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix = "qlsync-replay-home-")
+    # keep qlsync's caches, metrics and traces out of the real home
+    os.environ["HOME"] = workdir
+    os.environ.pop("QLSYNC_TRACE_DIR", None)
+    try:
+        with Quiet():
+            results = args.func(args)
+        print(json.dumps(results, indent = 2, sort_keys = True))
+    finally:
+        shutil.rmtree(workdir, True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Simon Guest
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+# Measure startup time of each qlsync entry point, and check that none
+# of them imports a transport or toolkit it doesn't need.  Run from the
+# top of the source tree; exits non-zero if any check fails.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# modules imported by each entry point, and modules it may import as a result
+ENTRY_POINTS = {
+    'qlsync': (['qlsync.gui'], ['gi']),
+    'qlsync-create-album-playlists': (['qlsync.engine'], []),
+    'qlsync-playlist-from-device': (['qlsync.engine'], []),
+    'qlsync-rename-troublesome-files': (['qlsync.renamer'], []),
+    'qlsync-sync': (['qlsync.engine'], []),
+}
+
+# modules which are slow to import, and only needed once a device or library is used
+HEAVY_MODULES = ['ftplib', 'gi', 'gtk', 'paramiko', 'quodlibet']
+
+PROBE = """
+import json, sys, time
+t0 = time.time()
+for m in sys.argv[1:]:
+    __import__(m)
+elapsed = time.time() - t0
+print(json.dumps({"elapsed": elapsed, "modules": sorted(sys.modules.keys())}))
+"""
+
+def probe(modules):
+    """Import modules in a fresh interpreter, returning (elapsed, loaded modules), or None if they can't be imported."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.getcwd()] + [p for p in [env.get('PYTHONPATH')] if p])
+    p = subprocess.Popen([sys.executable, "-c", PROBE] + modules, stdout = subprocess.PIPE, stderr = subprocess.PIPE, env = env)
+    stdout, stderr = p.communicate()
+    if p.returncode != 0:
+        return None
+    result = json.loads(stdout)
+    return result['elapsed'], result['modules']
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--repeat", type=int, default=5, help="runs per entry point, best is reported")
+    args = parser.parse_args()
+
+    results = {}
+    ok = True
+    for name in sorted(ENTRY_POINTS.keys()):
+        modules, allowed = ENTRY_POINTS[name]
+        timings = []
+        loaded = None
+        for i in range(args.repeat):
+            r = probe(modules)
+            if r is None:
+                break
+            timings.append(r[0])
+            loaded = r[1]
+        if loaded is None:
+            results[name] = {"skipped": "import failed"}
+            continue
+        heavy = sorted(m for m in HEAVY_MODULES if m in loaded and m not in allowed)
+        if heavy:
+            ok = False
+        results[name] = {"best_seconds": min(timings), "heavy_modules": heavy}
+    print(json.dumps(results, indent = 2, sort_keys = True))
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
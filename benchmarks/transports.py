@@ -0,0 +1,518 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Simon Guest
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+# Benchmark scan and sync cycles of a synthetic library against local
+# stand-ins for each transport: a tmpfs directory for the filesystem
+# shifter, a loopback FTP server (needs pyftpdlib), a local SFTP server
+# (needs paramiko), a fake adb on PATH, and a simulated in-memory device
+# whose link latency and bandwidth are given as options.  Run from the
+# top of the source tree; results are printed as JSON.
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.getcwd())
+
+TRANSPORTS = ['filesystem', 'ftp', 'sftp', 'adb', 'memory']
+
+USER = "qlsync"
+PASSWORD = "qlsync"
+
+# a fake adb running device commands in a local shell
+FAKE_ADB = """#!/bin/sh
+[ "$1" = "-s" ] && shift 2
+cmd=$1; shift
+case "$cmd" in
+shell) if [ $# -eq 0 ]; then exec sh; fi; exec sh -c "$*";;
+push) n=$#; dst=$(eval echo \\${$n}); while [ $# -gt 1 ]; do cp "$1" "$dst" || exit 1; shift; done;;
+devices) echo "List of devices attached"; echo "bench	device";;
+esac
+"""
+
+# media scanner broadcasts are ignored
+FAKE_AM = """#!/bin/sh
+exit 0
+"""
+
+class Workload(object):
+    """A synthetic music library and Quod Libet playlists."""
+
+    def __init__(self, root, args):
+        self.musicdir = os.path.join(root, "music")
+        self.playlist_dir = os.path.join(root, "playlists")
+        self.rng = random.Random(args.seed)
+        self.tracks = []
+        self.total_bytes = 0
+        os.makedirs(self.playlist_dir)
+        block = os.urandom(1024 * 1024)
+        for i in range(args.tracks):
+            album = i // args.album_size
+            path = os.path.join(self.musicdir, "Artist %d" % (album % 50), "Album %d" % album, "%02d Track.mp3" % (i % args.album_size))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            size = max(1, int(self.rng.lognormvariate(0, args.size_sigma) * args.mean_size * 1024 * 1024))
+            with open(path, 'wb') as f:
+                remaining = size
+                while remaining > 0:
+                    f.write(block[:remaining])
+                    remaining -= len(block)
+            self.tracks.append(path)
+            self.total_bytes += size
+        # overlap is the chance each track comes from a small pool shared by all playlists
+        self.popular = self.rng.sample(self.tracks, max(1, len(self.tracks) // 10))
+        self.playlists = []
+        for i in range(args.playlists):
+            playlist = "playlist%03d" % i
+            self.write_playlist(playlist, self.choose_tracks(args.playlist_size, args.overlap))
+            self.playlists.append(playlist)
+
+    def choose_tracks(self, n, overlap):
+        chosen = []
+        seen = set()
+        while len(chosen) < min(n, len(self.tracks)):
+            pool = self.popular if self.rng.random() < overlap else self.tracks
+            track = self.rng.choice(pool)
+            if track not in seen:
+                seen.add(track)
+                chosen.append(track)
+        return chosen
+
+    def write_playlist(self, playlist, tracks):
+        with open(os.path.join(self.playlist_dir, playlist), 'w') as f:
+            f.write("".join(["%s\n" % track for track in tracks]))
+
+    def read_playlist(self, playlist):
+        with open(os.path.join(self.playlist_dir, playlist)) as f:
+            return [line.rstrip("\n") for line in f]
+
+    def edit_playlist(self, playlist, overlap):
+        """Replace half the tracks in playlist, bumping its mtime as Quod Libet would."""
+        tracks = self.read_playlist(playlist)
+        keep = tracks[:len(tracks) // 2]
+        self.write_playlist(playlist, keep + self.choose_tracks(len(tracks) - len(keep), overlap))
+        s = os.stat(os.path.join(self.playlist_dir, playlist))
+        os.utime(os.path.join(self.playlist_dir, playlist), (s.st_atime, s.st_mtime + 1))
+
+    def expected(self, wanted):
+        """Return the set of paths relative to musicdir which should be on the device."""
+        paths = set()
+        for playlist, want in zip(self.playlists, wanted):
+            if want:
+                for track in self.read_playlist(playlist):
+                    paths.add(os.path.relpath(track, self.musicdir))
+        return paths
+
+def device_contents(devicedir):
+    """Return the set of music files on a device stand-in, relative to its music dir."""
+    paths = set()
+    for dirpath, dirnames, filenames in os.walk(devicedir):
+        for filename in filenames:
+            path = os.path.relpath(os.path.join(dirpath, filename), devicedir)
+            if not path.startswith("qlsync/"):
+                paths.add(path)
+    return paths
+
+class StandIn(object):
+    """A local stand-in for a device, made from a scratch root directory and the benchmark options."""
+
+    def contents(self):
+        """Return the set of music files on the device, relative to its music dir."""
+        return device_contents(self.devicedir)
+
+class FilesystemStandIn(StandIn):
+    """A tmpfs directory, if there is one."""
+
+    def __init__(self, root, args):
+        base = "/dev/shm" if os.access("/dev/shm", os.W_OK) else root
+        self.root = tempfile.mkdtemp(prefix = "qlsync-bench-", dir = base)
+        self.devicedir = os.path.join(self.root, "music")
+
+    def shifter(self):
+        from qlsync.shifters import FilesystemShifter
+        return FilesystemShifter()
+
+    def musicdir(self):
+        return self.devicedir
+
+    def stop(self):
+        shutil.rmtree(self.root, True)
+
+class FtpStandIn(StandIn):
+    """A loopback FTP server, serving root."""
+
+    def __init__(self, root, args):
+        from pyftpdlib.authorizers import DummyAuthorizer
+        from pyftpdlib.handlers import FTPHandler
+        from pyftpdlib.servers import ThreadedFTPServer
+        self.root = os.path.join(root, "ftp")
+        os.makedirs(self.root)
+        self.devicedir = os.path.join(self.root, "music")
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(USER, PASSWORD, self.root, perm = "elradfmwMT")
+        handler = FTPHandler
+        handler.authorizer = authorizer
+        self.server = ThreadedFTPServer(("127.0.0.1", 0), handler)
+        self.port = self.server.socket.getsockname()[1]
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def shifter(self):
+        from qlsync.shifters import FtpShifter
+        return FtpShifter("127.0.0.1", USER, PASSWORD, self.port)
+
+    def musicdir(self):
+        return "/music"
+
+    def stop(self):
+        self.server.close_all()
+
+class SftpStandIn(StandIn):
+    """A local SFTP server on a loopback port, serving root, which takes any key."""
+
+    def __init__(self, root, args):
+        import paramiko
+        self.root = os.path.join(root, "sftp")
+        os.makedirs(self.root)
+        self.devicedir = os.path.join(self.root, "music")
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.client_key = paramiko.RSAKey.generate(2048)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+        self.transports = []
+        self.thread = threading.Thread(target = self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        import paramiko
+        root = self.root
+
+        class Server(paramiko.ServerInterface):
+            def check_auth_publickey(self, username, key):
+                return paramiko.AUTH_SUCCESSFUL
+            def get_allowed_auths(self, username):
+                return "publickey"
+            def check_channel_request(self, kind, chanid):
+                return paramiko.OPEN_SUCCEEDED
+
+        class Handle(paramiko.SFTPHandle):
+            def stat(self):
+                try:
+                    return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+                except OSError as e:
+                    return paramiko.SFTPServer.convert_errno(e.errno)
+
+        class Sftp(paramiko.SFTPServerInterface):
+            def local(self, path):
+                return os.path.join(root, self.canonicalize(path).lstrip("/"))
+            def list_folder(self, path):
+                try:
+                    local = self.local(path)
+                    result = []
+                    for name in os.listdir(local):
+                        attr = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(local, name)))
+                        attr.filename = name
+                        result.append(attr)
+                    return result
+                except OSError as e:
+                    return paramiko.SFTPServer.convert_errno(e.errno)
+            def stat(self, path):
+                try:
+                    return paramiko.SFTPAttributes.from_stat(os.stat(self.local(path)))
+                except OSError as e:
+                    return paramiko.SFTPServer.convert_errno(e.errno)
+            def lstat(self, path):
+                try:
+                    return paramiko.SFTPAttributes.from_stat(os.lstat(self.local(path)))
+                except OSError as e:
+                    return paramiko.SFTPServer.convert_errno(e.errno)
+            def open(self, path, flags, attr):
+                try:
+                    fd = os.open(self.local(path), flags, 0644)
+                except OSError as e:
+                    return paramiko.SFTPServer.convert_errno(e.errno)
+                if flags & os.O_WRONLY:
+                    mode = "ab" if flags & os.O_APPEND else "wb"
+                elif flags & os.O_RDWR:
+                    mode = "a+b" if flags & os.O_APPEND else "r+b"
+                else:
+                    mode = "rb"
+                handle = Handle(flags)
+                handle.filename = self.local(path)
+                handle.readfile = handle.writefile = os.fdopen(fd, mode)
+                return handle
+            def remove(self, path):
+                try:
+                    os.remove(self.local(path))
+                except OSError as e:
+                    return paramiko.SFTPServer.convert_errno(e.errno)
+                return paramiko.SFTP_OK
+            def rename(self, oldpath, newpath):
+                try:
+                    os.rename(self.local(oldpath), self.local(newpath))
+                except OSError as e:
+                    return paramiko.SFTPServer.convert_errno(e.errno)
+                return paramiko.SFTP_OK
+            def mkdir(self, path, attr):
+                try:
+                    os.mkdir(self.local(path))
+                except OSError as e:
+                    return paramiko.SFTPServer.convert_errno(e.errno)
+                return paramiko.SFTP_OK
+            def rmdir(self, path):
+                try:
+                    os.rmdir(self.local(path))
+                except OSError as e:
+                    return paramiko.SFTPServer.convert_errno(e.errno)
+                return paramiko.SFTP_OK
+            def chattr(self, path, attr):
+                try:
+                    paramiko.SFTPServer.set_file_attr(self.local(path), attr)
+                except OSError as e:
+                    return paramiko.SFTPServer.convert_errno(e.errno)
+                return paramiko.SFTP_OK
+
+        while True:
+            try:
+                conn, addr = self.listener.accept()
+            except socket.error:
+                break
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, Sftp)
+            transport.start_server(server = Server())
+            self.transports.append(transport)
+
+    def shifter(self):
+        from qlsync.shifters import SftpShifter
+        client_key = self.client_key
+
+        class BenchSftpShifter(SftpShifter):
+            """Authenticate with our own key rather than ssh-agent."""
+            def private_key(self):
+                return client_key
+
+        return BenchSftpShifter("127.0.0.1", USER, self.port)
+
+    def musicdir(self):
+        return "/music"
+
+    def stop(self):
+        self.listener.close()
+        for transport in self.transports:
+            transport.close()
+
+class AdbStandIn(StandIn):
+    """A fake adb on PATH, running device commands on a local directory."""
+
+    def __init__(self, root, args):
+        self.root = os.path.join(root, "adb")
+        self.devicedir = os.path.join(self.root, "sdcard", "music")
+        bindir = os.path.join(self.root, "bin")
+        os.makedirs(bindir)
+        os.makedirs(os.path.dirname(self.devicedir))
+        for name, script in (("adb", FAKE_ADB), ("am", FAKE_AM)):
+            path = os.path.join(bindir, name)
+            with open(path, 'w') as f:
+                f.write(script)
+            os.chmod(path, stat.S_IRWXU)
+        self.path = os.environ["PATH"]
+        os.environ["PATH"] = bindir + os.pathsep + self.path
+
+    def shifter(self):
+        from qlsync.shifters import AdbShifter
+        return AdbShifter(os.path.dirname(self.devicedir), "bench")
+
+    def musicdir(self):
+        return self.devicedir
+
+    def stop(self):
+        os.environ["PATH"] = self.path
+
+class MemoryStandIn(StandIn):
+    """A simulated in-memory device, over a link of the given latency and bandwidth, taking real time."""
+
+    def __init__(self, root, args):
+        from qlsync.shifters import MemoryDevice
+        self.device = MemoryDevice()
+        self.devicedir = "/music"
+        self.latency = args.latency
+        self.bandwidth = args.bandwidth
+
+    def shifter(self):
+        from qlsync.shifters import MemoryShifter
+        return MemoryShifter(self.device, latency = self.latency, bandwidth = self.bandwidth, realtime = True)
+
+    def musicdir(self):
+        return self.devicedir
+
+    def contents(self):
+        paths = set()
+        for path in self.device.files.keys():
+            path = os.path.relpath(path, self.devicedir)
+            if not path.startswith("qlsync/"):
+                paths.add(path)
+        return paths
+
+    def stop(self):
+        pass
+
+STAND_INS = {
+    'filesystem': FilesystemStandIn,
+    'ftp': FtpStandIn,
+    'sftp': SftpStandIn,
+    'adb': AdbStandIn,
+    'memory': MemoryStandIn,
+}
+
+class Quiet(object):
+    """Discard qlsync's chatter on stdout for the duration."""
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def shifter_summary(name):
+    """Return per-method count, seconds and bytes from the last metrics report of the benchmark device."""
+    from qlsync.metrics import METRICS_DIR
+    try:
+        with open(os.path.join(METRICS_DIR, "bench-%s.json" % name)) as f:
+            report = json.load(f)
+    except (IOError, ValueError):
+        return None
+    return dict([(method, {"count": stats["count"], "seconds": stats["seconds"], "bytes": stats["bytes"]})
+                 for method, stats in report["methods"].items()])
+
+def run_scan(syncer, device):
+    t0 = time.time()
+    with Quiet():
+        syncer.scan_device(device)
+    return {"seconds": time.time() - t0, "shifter": shifter_summary("scan")}
+
+def run_sync(syncer, device, wanted, workload, stand_in):
+    done = {}
+    def progress(fraction, complete = False, stats = None):
+        if complete:
+            done.update(stats or {})
+    labels = []
+    t0 = time.time()
+    with Quiet():
+        scribe = syncer.sync_device(device, wanted, labels.append, progress)
+        scribe.join()
+        syncer.sync_device_completed(1, device)
+    seconds = time.time() - t0
+    result = {
+        "seconds": seconds,
+        "files": done.get("files_done", 0),
+        "bytes": done.get("bytes_done", 0),
+        "deletions": done.get("deletions_done", 0),
+        "files_per_second": done.get("files_done", 0) / seconds,
+        "mb_per_second": done.get("bytes_done", 0) / 1e6 / seconds,
+        "verified": stand_in.contents() == workload.expected(wanted),
+        "shifter": shifter_summary("sync"),
+    }
+    if labels and labels[-1].startswith("sync failed"):
+        result["error"] = labels[-1]
+    return result
+
+def run_transport(name, root, args):
+    """Run the scan and sync cycles for one transport, returning results by phase."""
+    from qlsync.engine import Device, Library, Syncer
+    # each transport starts from the same library
+    workload = Workload(os.path.join(root, "library"), args)
+    stand_in = STAND_INS[name](root, args)
+    try:
+        with Quiet():
+            library = Library([workload.musicdir], workload.playlist_dir)
+            syncer = Syncer(library)
+            device = Device("bench", stand_in.musicdir(), stand_in.shifter(), connections = args.connections)
+        n = len(workload.playlists)
+        phases = []
+        phases.append(("first_scan", run_scan(syncer, device)))
+        phases.append(("initial_sync", run_sync(syncer, device, [True] * n, workload, stand_in)))
+        phases.append(("rescan", run_scan(syncer, device)))
+        phases.append(("noop_sync", run_sync(syncer, device, [True] * n, workload, stand_in)))
+        for playlist in workload.playlists[:max(1, n // 10)]:
+            workload.edit_playlist(playlist, args.overlap)
+        phases.append(("incremental_sync", run_sync(syncer, device, [True] * n, workload, stand_in)))
+        phases.append(("removal_sync", run_sync(syncer, device, [i % 2 == 0 for i in range(n)], workload, stand_in)))
+        phases.append(("final_scan", run_scan(syncer, device)))
+        syncer.cleanup()
+        return {
+            "library_bytes": workload.total_bytes,
+            "phases": dict(phases),
+            "total_seconds": sum([phase["seconds"] for key, phase in phases]),
+        }
+    finally:
+        stand_in.stop()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--transports", default = ",".join(TRANSPORTS), help = "comma separated, from %s" % ", ".join(TRANSPORTS))
+    parser.add_argument("--tracks", type = int, default = 500, help = "tracks in library")
+    parser.add_argument("--album-size", type = int, default = 12, help = "tracks per album")
+    parser.add_argument("--mean-size", type = float, default = 0.5, help = "median track size in MB")
+    parser.add_argument("--size-sigma", type = float, default = 0.5, help = "sigma of lognormal track size distribution")
+    parser.add_argument("--playlists", type = int, default = 20, help = "playlists in library")
+    parser.add_argument("--playlist-size", type = int, default = 40, help = "tracks per playlist")
+    parser.add_argument("--overlap", type = float, default = 0.3, help = "chance each playlist track comes from a shared pool")
+    parser.add_argument("--connections", type = int, default = 1, help = "connections per device")
+    parser.add_argument("--latency", type = float, default = 0.0, help = "simulated seconds per round trip, for memory")
+    parser.add_argument("--bandwidth", type = float, help = "simulated bytes per second, for memory")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("-o", "--output", help = "write results to this file too")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix = "qlsync-bench-")
+    # keep qlsync's caches and metrics out of the real home
+    os.environ["HOME"] = os.path.join(workdir, "home")
+    os.makedirs(os.environ["HOME"])
+    try:
+        results = {
+            "config": vars(args),
+            "transports": {},
+        }
+        for name in args.transports.split(","):
+            root = os.path.join(workdir, name)
+            os.makedirs(root)
+            try:
+                results["transports"][name] = run_transport(name, root, args)
+            except ImportError as e:
+                results["transports"][name] = {"skipped": str(e)}
+            shutil.rmtree(os.path.join(os.environ["HOME"], ".cache"), True)
+        output = json.dumps(results, indent = 2, sort_keys = True)
+        print(output)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(output + "\n")
+        ok = True
+        for result in results["transports"].values():
+            for phase in result.get("phases", {}).values():
+                if phase.get("verified") is False or "error" in phase:
+                    ok = False
+        sys.exit(0 if ok else 1)
+    finally:
+        shutil.rmtree(workdir, True)
+
+if __name__ == '__main__':
+    main()
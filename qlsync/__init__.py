@@ -4,4 +4,4 @@
 # it under the terms of the GNU General Public License version 2 as
 # published by the Free Software Foundation
 
-all = ['engine', 'gui', 'shifters', 'shifters_gui']
+all = ['engine', 'gui', 'metrics', 'shifters', 'shifters_gui', 'trace']
@@ -4,46 +4,228 @@
 # it under the terms of the GNU General Public License version 2 as
 # published by the Free Software Foundation
 
+from array import array
+import copy
+import hashlib
 import pickle
 import os
 import os.path
+import Queue
 import re
 import shutil
 import sys
 import tempfile
 import threading
+import time
 import urllib
 import urlparse
 
-import quodlibet
-import quodlibet.config
-import quodlibet.formats
-import quodlibet.library
-
 from qlsync import *
+from qlsync.metrics import InstrumentedShifter, Metrics
+from qlsync.trace import trace_recorder, tracing_enabled
 from qlsync.shifters import ShifterError
 
+# files removed per call to shifter.removefiles
+DELETE_BATCH_SIZE = 100
+
+# plan items buffered between planner and scribe
+PLAN_QUEUE_SIZE = 256
+
+# limits on music files read ahead into local staging, awaiting upload
+READ_AHEAD_FILES = 64
+READ_AHEAD_BYTES = 128 * 1024 * 1024
+
+# progress weight of deleting a file, in bytes transferred
+DELETE_WEIGHT_BYTES = 64 * 1024
+
+# seconds of history in the throughput moving average
+THROUGHPUT_WINDOW = 10.0
+
+# where device state is cached between runs
+STATE_CACHE_DIR = os.path.expanduser("~/.cache/qlsync")
+
+# bump this when cached state changes shape
+STATE_VERSION = 3
+
 def ascify(s):
     """Convert Unicode string to ASCII, discarding out-of-bounds characters."""
     return s.encode('ascii', 'ignore')
 
+def file_md5(path):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(1 << 20)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+def source_signature(path, with_hash = False):
+    """Return (size, mtime, md5) for path, with md5 None unless with_hash."""
+    s = os.stat(path)
+    if with_hash:
+        md5 = file_md5(path)
+    else:
+        md5 = None
+    return (s.st_size, int(s.st_mtime), md5)
+
+class PathTable(object):
+    """Interned paths, each stored once and known elsewhere by its integer id.
+
+Ids are allocated densely from zero, so may index arrays.  Sets of
+paths are held as sorted arrays of ids.
+"""
+    def __init__(self, paths = ()):
+        self.paths = []                  # indexed by id
+        self.ids = {}                    # indexed by path
+        self.lock = threading.Lock()
+        for path in paths:
+            self.intern(path)
+
+    def __getstate__(self):
+        # the lock can't be pickled, and ids are rebuilt from paths
+        return (self.paths,)
+
+    def __setstate__(self, state):
+        self.__init__(state[0])
+
+    def __len__(self):
+        return len(self.paths)
+
+    def intern(self, path):
+        """Return the id of path, adding it if new."""
+        i = self.ids.get(path)
+        if i is None:
+            with self.lock:
+                i = self.ids.get(path)
+                if i is None:
+                    i = len(self.paths)
+                    self.paths.append(path)
+                    self.ids[path] = i
+        return i
+
+    def get(self, path):
+        """Return the id of path, or None if not interned."""
+        return self.ids.get(path)
+
+    def path(self, i):
+        return self.paths[i]
+
+    def intern_set(self, paths):
+        """Return the set of paths as a sorted array of ids."""
+        return array('l', sorted(set([self.intern(path) for path in paths])))
+
+def sorted_difference(a, b):
+    """Return the sorted array of ids in sorted array a but not in sorted array b."""
+    result = array('l')
+    j = 0
+    n = len(b)
+    for i in a:
+        while j < n and b[j] < i:
+            j += 1
+        if j == n or b[j] != i:
+            result.append(i)
+    return result
+
+class Manifest(object):
+    """Record of what qlsync has put on the device, kept in the device playlist dir.
+
+For each music file uploaded, holds the signature of its source, and
+for each playlist, its contents as on the device and the signature of
+the library playlist it was made from.  The text format is line based,
+to cope with paths in any encoding.
+"""
+    MAGIC = "qlsync-manifest 1"
+
+    def __init__(self):
+        self.generation = 0
+        self.files = {}                  # indexed by devicepath, of source_signature
+        self.paths = PathTable()         # of music files in playlists
+        self.playlists = {}              # indexed by playlist_name, of array of path ids of music files in playlist
+        self.sources = {}                # indexed by playlist_name, of PlaylistCache.signature
+        self.dirty = False               # changed other than by uploads and deletions
+
+    def load(self, lines):
+        """Load from lines, returning whether they were a valid manifest."""
+        if not lines or lines[0] != Manifest.MAGIC:
+            return False
+        playlist = None
+        try:
+            for line in lines[1:]:
+                kind, sep, rest = line.partition(" ")
+                if kind == "generation":
+                    self.generation = int(rest)
+                elif kind == "file":
+                    size, mtime, md5, devicepath = rest.split(" ", 3)
+                    self.files[devicepath] = (int(size), int(mtime), None if md5 == "-" else md5)
+                elif kind == "source":
+                    flatten, size, mtime, playlist_name = rest.split(" ", 3)
+                    self.sources[playlist_name] = (flatten == "1", int(size), float(mtime))
+                elif kind == "playlist":
+                    playlist = self.playlists.setdefault(rest, array('l'))
+                elif kind == "entry" and playlist is not None:
+                    playlist.append(self.paths.intern(rest))
+        except ValueError:
+            self.__init__()
+            return False
+        return True
+
+    def write(self, f):
+        f.write("%s\n" % Manifest.MAGIC)
+        f.write("generation %d\n" % self.generation)
+        for devicepath in sorted(self.files.keys()):
+            size, mtime, md5 = self.files[devicepath]
+            f.write("file %d %d %s %s\n" % (size, mtime, md5 or "-", devicepath))
+        for playlist_name in sorted(self.sources.keys()):
+            flatten, size, mtime = self.sources[playlist_name]
+            f.write("source %d %d %r %s\n" % (flatten, size, mtime, playlist_name))
+        for playlist_name in sorted(self.playlists.keys()):
+            f.write("playlist %s\n" % playlist_name)
+            for i in self.playlists[playlist_name]:
+                f.write("entry %s\n" % self.paths.path(i))
+
+    def set_playlist(self, playlist_name, musicfiles):
+        self.playlists[playlist_name] = array('l', [self.paths.intern(musicfile) for musicfile in musicfiles])
+
+    def compact(self):
+        """Forget paths no longer in any playlist, renumbering the rest, so the table doesn't grow without bound."""
+        live = set()
+        for ids in self.playlists.values():
+            live.update(ids)
+        if len(live) == len(self.paths):
+            return
+        # keeping the order keeps sorted arrays of ids sorted
+        paths = PathTable([self.paths.path(i) for i in sorted(live)])
+        for playlist_name, ids in self.playlists.items():
+            self.playlists[playlist_name] = array('l', [paths.get(self.paths.path(i)) for i in ids])
+        self.paths = paths
+
 class Device(object):
     """Access to files on the device."""
-    def __init__(self, name, musicdir, shifter, flatten = False):
+
+    # defaults for devices pickled before these settings existed
+    connections = 1
+    manifest_hash = False               # whether to keep an md5 of sources in the manifest
+
+    def __init__(self, name, musicdir, shifter, flatten = False, connections = 1):
         self.name = name
         self.musicdir = musicdir
         self.shifter = shifter
         self.flatten = flatten
+        self.connections = connections
         self.clear_non_persistent()
 
     def clear_non_persistent(self):
         """Clear non-persistent settings."""
-        self.playlist_files = {}         # indexed by playlist_name, of set of music files
-        self.all_songs = set()
+        self.playlist_files = {}         # indexed by playlist_name, of sorted array of manifest path ids
+        self.refcounts = array('l')      # indexed by manifest path id, of number of playlists containing it
+        self.inventory = None            # dict of (size, mtime) indexed by path relative to musicdir, if known
+        self.manifest = Manifest()
 
     def __str__(self):
         return "Device(name=" + self.name + ",musicdir=" + self.musicdir + ",flatten=" + str(self.flatten) + \
-               ",shifter=" + str(self.shifter) + ")"
+               ",connections=" + str(self.connections) + ",shifter=" + str(self.shifter) + ")"
 
     def playlist_dir(self):
         return os.path.join(self.musicdir, "qlsync")
@@ -59,34 +241,244 @@ class Device(object):
         # hand - or use a future version of this program ;-)
         return os.path.join("qlsync", playlist_name + ".qls")
 
+    def playlist_name(self, playlist_file):
+        """The opposite of playlist_file."""
+        return re.sub(r'\.qls$', '', os.path.basename(playlist_file))
+
+    def manifest_file(self):
+        return os.path.join("qlsync", "manifest")
+
     def musicfile_actual_path(self, musicfile_in_playlist):
         """Given a musicfile in a device playlist, return the actual pathname.  The opposite of musicfile_playlist_path."""
         return os.path.normpath(os.path.join("qlsync", musicfile_in_playlist))
 
-    def scan(self):
-        """Get device storage space and all the playlists from the device, by looking in the playlist dir for qls files."""
+    def has_file(self, devicepath):
+        """Whether devicepath is on the device, as far as we know."""
+        return self.inventory is None or devicepath in self.inventory
+
+    def source_changed(self, devicepath, abspath):
+        """Whether the source of devicepath has changed since it was uploaded, according to the manifest."""
+        uploaded = self.manifest.files.get(devicepath)
+        if uploaded is None:
+            # not uploaded by a version of qlsync with a manifest, so can't tell
+            return False
+        size, mtime, md5 = uploaded
+        try:
+            current = source_signature(abspath)
+        except OSError:
+            # gone from the library, so what's on the device is as good as it gets
+            print("missing source %s for %s" % (abspath, devicepath))
+            return False
+        if current[:2] == (size, mtime):
+            return False
+        if md5 is not None and file_md5(abspath) == md5:
+            # touched but not changed, so just remember the new mtime
+            self.manifest.files[devicepath] = (current[0], current[1], md5)
+            self.manifest.dirty = True
+            return False
+        return True
+
+    def record_upload(self, devicepath, abspath):
+        self.manifest.files[devicepath] = source_signature(abspath, self.manifest_hash)
+
+    def record_playlist_upload(self, playlist_file, src, source):
+        playlist_name = self.playlist_name(playlist_file)
+        with open(src) as f:
+            self.manifest.set_playlist(playlist_name, [line.rstrip("\n") for line in f])
+        self.record_playlist_source(playlist_name, source)
+
+    def record_playlist_source(self, playlist_name, source):
+        """Record the signature of the library playlist which playlist_name on the device was made from."""
+        if self.manifest.sources.get(playlist_name) == source:
+            return
+        if source is None:
+            del self.manifest.sources[playlist_name]
+        else:
+            self.manifest.sources[playlist_name] = source
+        self.manifest.dirty = True
+
+    def playlist_unchanged(self, playlist_name, source):
+        """Whether playlist_name on the device was made from a library playlist with signature source."""
+        return playlist_name in self.playlist_files and self.manifest.sources.get(playlist_name) == source
+
+    def record_deletion(self, devicepath):
+        self.manifest.files.pop(devicepath, None)
+        if devicepath.startswith("qlsync/") and devicepath.endswith(".qls"):
+            self.manifest.playlists.pop(self.playlist_name(devicepath), None)
+            self.manifest.sources.pop(self.playlist_name(devicepath), None)
+
+    def write_manifest(self, shifter):
+        """Write the manifest onto the device, or remove it if there are no playlists."""
+        manifest_path = os.path.join(self.musicdir, self.manifest_file())
+        self.manifest.generation += 1
+        self.manifest.dirty = False
+        if not self.manifest.playlists:
+            try:
+                shifter.removefile(manifest_path)
+            except ShifterError:
+                pass
+            shifter.removedir_if_empty(self.playlist_dir())
+            return
+        fd, tmpfile = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, "w") as f:
+                self.manifest.write(f)
+            shifter.makedirs(self.playlist_dir())
+            shifter.uploadfile(tmpfile, manifest_path)
+        finally:
+            os.remove(tmpfile)
+
+    def inventory_dirs(self):
+        """Return the set of directories containing files in the inventory."""
+        return set([os.path.dirname(os.path.join(self.musicdir, devicepath)) for devicepath in self.inventory])
+
+    def scan(self, inventory = False, use_cache = True):
+        """Get device storage space and all the playlists from the device, by looking in the playlist dir for qls files.
+If inventory, also take an inventory of every file in the music dir.
+Playlists are taken from the local state cache if the device is unchanged since it was saved,
+except when tracing, so that the trace has everything needed to replay the scan."""
         self.clear_non_persistent()
-        self.shifter.open()
-        usage = self.shifter.get_storage_space(self.musicdir)
+        if tracing_enabled():
+            use_cache = False
+        self.instrument("scan", {"inventory": inventory, "use_cache": use_cache})
+        try:
+            self.shifter.open()
+            try:
+                usage = self.shifter.get_storage_space(self.musicdir)
+                if inventory and self.shifter.path_exists(self.musicdir):
+                    self.inventory = self.shifter.walk_stat(self.musicdir)
+                token = self.state_token(self.shifter)
+                if use_cache and token is not None and self.load_state(token):
+                    print("using cached state for %s" % self.name)
+                else:
+                    self.scan_playlists()
+                    self.save_state(token)
+            finally:
+                # even if the scan failed, so no session is left open
+                self.shifter.close()
+        finally:
+            self.uninstrument("scan")
+        return usage
+
+    def instrument(self, activity, trace_info = {}):
+        """Record metrics of all shifter calls for activity, until uninstrument.
+If tracing is enabled, also trace the calls, with trace_info in the trace header."""
+        self.uninstrument(None)
+        header = {
+            "device": self.name,
+            "musicdir": self.musicdir,
+            "flatten": self.flatten,
+            "connections": self.connections,
+            "shifter": str(self.shifter),
+            "activity": activity,
+        }
+        header.update(trace_info)
+        self.shifter = InstrumentedShifter(self.shifter, Metrics(), trace_recorder(self.name, activity, header))
+
+    def uninstrument(self, activity):
+        """Stop recording metrics, writing them out for activity if given."""
+        if isinstance(self.shifter, InstrumentedShifter):
+            metrics = self.shifter.metrics
+            recorder = self.shifter.recorder
+            self.shifter = self.shifter.shifter
+            if activity is not None:
+                metrics.dump(self.name, activity)
+            if recorder is not None:
+                recorder.close()
+                print("trace written to %s" % recorder.path)
+
+    def scan_playlists(self):
+        """Get all the playlists from the device, from the manifest if it is up to date."""
         if self.shifter.path_exists(self.playlist_dir()):
+            playlist_names = {}         # indexed by playlist file path
+            have_manifest = False
             for f in self.shifter.ls(self.playlist_dir()):
                 m = re.match(r'^(.*)\.qls', f)
                 if m:
                     playlist_file = m.group(0)
                     playlist_name = m.group(1)
-                    playlist_contents = self.shifter.readlines(os.path.join(self.playlist_dir(), playlist_file))
-                    self.playlist_files[playlist_name] = set(playlist_contents)
-                    self.all_songs.update(self.playlist_files[playlist_name])
-        self.shifter.close()
-        return usage
-
-    # TODO remove obsolete:
-    # def playlist_name(self, playlistfile):
-    #     m = re.match(r'^(.*)\.m3u', f)
-    #     if m:
-    #         return m.group(1)
-    #     else:
-    #         return None
+                    playlist_names[os.path.join(self.playlist_dir(), playlist_file)] = playlist_name
+                elif f == os.path.basename(self.manifest_file()):
+                    have_manifest = True
+            if have_manifest:
+                self.manifest.load(self.shifter.readlines(os.path.join(self.musicdir, self.manifest_file())))
+            if set(self.manifest.playlists.keys()) != set(playlist_names.values()):
+                # read them all in one go
+                all_contents = self.shifter.readlines_many(sorted(playlist_names.keys()))
+                self.manifest.playlists = {}
+                for playlist_path, playlist_contents in all_contents.items():
+                    self.manifest.set_playlist(playlist_names[playlist_path], playlist_contents)
+                # don't trust what we knew about their sources
+                self.manifest.sources = {}
+        self.use_manifest_playlists()
+
+    def use_manifest_playlists(self):
+        """Take playlists from the manifest, which mustn't be in use by a planner, since its path ids may change."""
+        self.manifest.compact()
+        self.playlist_files = {}
+        self.refcounts = array('l', [0]) * len(self.manifest.paths)
+        for playlist_name, playlist_contents in self.manifest.playlists.items():
+            self.playlist_files[playlist_name] = array('l', sorted(set(playlist_contents)))
+            for i in self.playlist_files[playlist_name]:
+                self.refcounts[i] += 1
+
+    def refcount(self, i):
+        """Return the number of playlists on the device containing the music file with path id i."""
+        if i < len(self.refcounts):
+            return self.refcounts[i]
+        return 0
+
+    def state_file(self):
+        return os.path.join(STATE_CACHE_DIR, urllib.quote(self.name, safe = "") + ".state")
+
+    def state_token(self, shifter):
+        """Return a token which changes whenever the playlists on the device may have, or None if there's no way to tell."""
+        dir_mtime, manifest_mtime = shifter.getmtimes([self.playlist_dir(), os.path.join(self.musicdir, self.manifest_file())])
+        # the manifest is rewritten on every sync, but some servers can't say when a directory changed
+        if manifest_mtime is None:
+            return None
+        return (self.musicdir, dir_mtime, manifest_mtime)
+
+    def load_state(self, token):
+        """Load state from local cache, returning whether it was valid for token."""
+        try:
+            with open(self.state_file(), 'rb') as f:
+                version = pickle.load(f)
+                cached_token = pickle.load(f)
+                if version != STATE_VERSION or cached_token != token:
+                    return False
+                self.manifest = pickle.load(f)
+        except Exception:
+            # missing or corrupt, so ignore
+            return False
+        self.use_manifest_playlists()
+        return True
+
+    def save_state(self, token):
+        """Save state to local cache, or discard it if there is no valid token."""
+        state_file = self.state_file()
+        try:
+            if token is None:
+                if os.path.exists(state_file):
+                    os.remove(state_file)
+                return
+            if not os.path.isdir(STATE_CACHE_DIR):
+                os.makedirs(STATE_CACHE_DIR)
+            with open(state_file, 'wb') as f:
+                pickle.dump(STATE_VERSION, f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(token, f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(self.manifest, f, pickle.HIGHEST_PROTOCOL)
+        except (IOError, OSError) as e:
+            print("save state failed: %s" % str(e))
+
+    def update_state(self, shifter):
+        """Bring playlists and local state cache up to date after a sync, according to the manifest."""
+        self.use_manifest_playlists()
+        try:
+            token = self.state_token(shifter)
+        except ShifterError:
+            token = None
+        self.save_state(token)
 
     def flush(self):
         """Clean up and flush out changes."""
@@ -119,12 +511,13 @@ class Settings(object):
     def save(self):
         self.clear_non_persistent()
         try:
+            # pickle before truncating the file, so a failure leaves the old settings
+            data = pickle.dumps(self.devices) + pickle.dumps(self.currentDeviceIndex)
             f = open(self.configFile, 'w')
             os.fchmod(f.fileno(), 0600)               # might have an FTP password here
-            pickle.dump(self.devices, f)
-            pickle.dump(self.currentDeviceIndex, f)
+            f.write(data)
             f.close()
-        except IOError as e:
+        except (IOError, pickle.PicklingError, TypeError) as e:
             print "save settings failed: " + str(e)
 
     def clear_non_persistent(self):
@@ -286,30 +679,51 @@ def album_name_and_artist(album):
     return album_name, artist
 
 class Library(object):
-    """Access to music files and playlists."""
-    def __init__(self):
-        quodlibet.config.init(quodlibet.const.CONFIG)
-        quodlibet.formats.init()
-        scanSettings = quodlibet.config.get("settings", "scan")
-        self.musicdirs = scanSettings.split(":")
-        self.playlist_dir = os.path.expanduser("~/.quodlibet/playlists")
-        self.quodlibet_library = quodlibet.library.init(quodlibet.const.LIBRARY)
+    """Access to music files and playlists.
+Music dirs and playlist dir are taken from Quod Libet, unless given."""
+    def __init__(self, musicdirs = None, playlist_dir = None):
+        if musicdirs is None:
+            # Quod Libet is only imported when the library is used, as it's slow to import
+            import quodlibet.config
+            import quodlibet.const
+            quodlibet.config.init(quodlibet.const.CONFIG)
+            scanSettings = quodlibet.config.get("settings", "scan")
+            musicdirs = scanSettings.split(":")
+        self.musicdirs = musicdirs
+        # for relativise, the roots without trailing slash, so / becomes empty
+        self.musicdir_roots = set([ldir.rstrip("/") for ldir in self.musicdirs if ldir != ""])
+        if playlist_dir is None:
+            playlist_dir = os.path.expanduser("~/.quodlibet/playlists")
+        self.playlist_dir = playlist_dir
+        self._quodlibet_library = None
+
+    @property
+    def quodlibet_library(self):
+        """The Quod Libet song library, only loaded when song metadata is needed, since it's big."""
+        if self._quodlibet_library is None:
+            import quodlibet.const
+            import quodlibet.formats
+            import quodlibet.library
+            quodlibet.formats.init()
+            self._quodlibet_library = quodlibet.library.init(quodlibet.const.LIBRARY)
+        return self._quodlibet_library
 
     def playlists(self):
         return sorted(os.listdir(self.playlist_dir))
 
     def relativise(self, abspath):
         """Return the path relative to a library root, or None."""
-        relpath = None
-        matchlen = 0
-        for ldir in self.musicdirs:
-            if abspath.startswith(ldir):
-                # want longest match, so we pick correctly between say
-                # /path/to/mp3 and /path/to/mp3-extra
-                if relpath == None or len(ldir) > matchlen:
-                    matchlen = len(ldir)
-                    relpath = abspath[matchlen:].lstrip("/")
-        return relpath
+        # Try each ancestor directory in turn, deepest first, so we get
+        # the longest match, and /path/to/mp3-extra/x is never taken
+        # to be under /path/to/mp3.
+        i = len(abspath)
+        while i > 0:
+            i = abspath.rfind("/", 0, i)
+            if i < 0:
+                break
+            if abspath[:i] in self.musicdir_roots:
+                return abspath[i:].lstrip("/")
+        return None
 
     def playlist_files(self, playlist):
         """Iterator for files in a playlist, which yields in pairs, (relpath, abspath)."""
@@ -335,15 +749,104 @@ class Library(object):
                     for song in refined_album.songs:
                         playlist.write("%s\n" % song['~filename'])
 
+class PlaylistCache(object):
+    """Device-side contents of library playlists, so unchanged playlists need not be parsed again.
+
+Entries are keyed by playlist and device flatten mode, and are valid
+while the playlist file's size and mtime are unchanged.  Kept in
+memory, and in cache_file if given.  Shared by the planners of
+concurrent syncs, so changes are made under lock.
+"""
+    def __init__(self, library, cache_file = None):
+        self.library = library
+        self.cache_file = cache_file
+        self.entries = {}                # indexed by (playlist, flatten), of (signature, list of (devicepath, devicepath_in_playlist, abspath))
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'rb') as f:
+                musicdirs = pickle.load(f)
+                entries = pickle.load(f)
+        except Exception as e:
+            print("ignoring playlist cache: %s" % str(e))
+            return
+        # a change in library roots changes every playlist
+        if musicdirs == self.library.musicdirs:
+            self.entries = entries
+
+    def save(self):
+        with self.lock:
+            if self.cache_file is None or not self.dirty:
+                return
+            try:
+                cache_dir = os.path.dirname(self.cache_file)
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                with open(self.cache_file, 'wb') as f:
+                    pickle.dump(self.library.musicdirs, f, pickle.HIGHEST_PROTOCOL)
+                    pickle.dump(self.entries, f, pickle.HIGHEST_PROTOCOL)
+                self.dirty = False
+            except (IOError, OSError) as e:
+                print("save playlist cache failed: %s" % str(e))
+
+    def prune(self, playlists):
+        """Forget playlists no longer in the library."""
+        playlists = set(playlists)
+        with self.lock:
+            for key in self.entries.keys():
+                if key[0] not in playlists:
+                    del self.entries[key]
+                    self.dirty = True
+
+    def signature(self, playlist, device):
+        """Return a signature which changes whenever the device-side contents of playlist may have changed."""
+        s = os.stat(os.path.join(self.library.playlist_dir, playlist))
+        return (device.flatten, s.st_size, s.st_mtime)
+
+    def device_playlist(self, playlist, device):
+        """Return list of (devicepath, devicepath_in_playlist, abspath) for playlist on device."""
+        signature = self.signature(playlist, device)[1:]
+        key = (playlist, device.flatten)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+        files = []
+        for relpath,abspath in self.library.playlist_files(playlist):
+            if device.flatten:
+                devicepath = flattened_path(relpath)
+            else:
+                devicepath = relpath
+            files.append((devicepath, device.musicfile_playlist_path(devicepath), abspath))
+        with self.lock:
+            self.entries[key] = (signature, files)
+            self.dirty = True
+        return files
+
 class Syncer(object):
     """Playlist synchronizer.
 Queue up file copies and deletions, ensuring not to delete files which are required.
 Files are not copied if they are already in the device playlist.
+
+Only playlists which are being added, removed or have changed since
+they were last synced are looked at, and a music file is deleted
+exactly when the last playlist on the device referring to it goes.
+
+One library scan serves any number of devices, which may be synced
+concurrently, each with its own planner and scribe.
 """
-    def __init__(self):
-        self.library = Library()
+    def __init__(self, library = None):
+        if library is None:
+            library = Library()
+        self.library = library
+        self.playlist_cache = PlaylistCache(self.library, os.path.join(STATE_CACHE_DIR, "playlists"))
         self.tmpdir = tempfile.mkdtemp()
-        self.scribe = None
+        self.syncs = {}                  # indexed by Device, of (planner, scribe, tmpdir) of sync in progress
+        self.syncs_lock = threading.Lock()
         self.scan_library()
         self.device_storage = (None, None) # unknown
 
@@ -352,6 +855,7 @@ Files are not copied if they are already in the device playlist.
         # Keep Quodlibet's encoded playlist names, as trying to store
         # decoded names is troublesome.
         self.playlists = self.library.playlists()
+        self.playlist_cache.prune(self.playlists)
         self.playlist_names = []
         self.playlist_index_by_name = {}
         self.playlists_on_device = [False] * len(self.playlists) # array of boolean
@@ -363,46 +867,147 @@ Files are not copied if they are already in the device playlist.
             i += 1
         self.notify_playlists_changed()
 
-    def scan_device(self, device):
-        """Scan what is on the device."""
-        usage = device.scan()
-        for playlist_name in device.playlist_files.keys():
-            if self.playlist_index_by_name.has_key(playlist_name):
-                i = self.playlist_index_by_name[playlist_name]
-                self.playlists_on_device[i] = True
-        self.notify_playlists_on_device_changed()
+    def scan_device(self, device, inventory = False):
+        """Scan what is on the device, including an inventory of all files if required.
+Returns the device storage usage."""
+        usage = device.scan(inventory)
+        self.update_playlists_on_device(device)
         self.notify_device_storage_changed(usage)
+        return usage
+
+    def playlists_on(self, device):
+        """Return array of boolean, whether each library playlist is on device."""
+        return [playlist in device.playlist_files for playlist in self.playlists]
+
+    def update_playlists_on_device(self, device):
+        self.playlists_on_device = self.playlists_on(device)
+        self.notify_playlists_on_device_changed()
 
     def get_device_storage(self):
         return self.device_storage
 
-    def sync_device(self, device, playlists_wanted, label_callback, progress_callback):
-        """Sync playlists, adding and deleting so that only playlists_wanted are present."""
-        print "writing data to device (do not unplug) ..."
-        self.scribe = Scribe(device, label_callback, progress_callback)
-        for i in range(len(self.playlists)):
-            if playlists_wanted[i]:
-                # wanted playlist, ensure it and all songs are on device
-                self.create_and_queue_playlist(self.playlists[i],
-                                               self.playlists[i],
-                                               device,
-                                               self.scribe)
-            elif self.playlists[i] in device.playlist_files.keys():
-                # unwanted playlist on device, so delete
-                self.delete_playlist(self.playlists[i], device, self.scribe)
-        self.scribe.start()
-
-    def cancel_sync(self):
-        if self.scribe != None:
-            self.scribe.cancel()
+    def sync_device(self, device, playlists_wanted, label_callback, progress_callback, verify = False):
+        """Sync playlists, adding and deleting so that only playlists_wanted are present.
+Unless verify, or there is an inventory of the device, playlists which are
+unchanged since last synced are skipped, so songs changed in the library
+since then are only found by a verified sync.
+
+Planning runs in its own thread, feeding the scribe as it goes, so
+copying starts as soon as the first playlist is planned.
+
+Other devices may be synced at the same time, but not the same one
+twice.  Returns the scribe, which finishes when the sync is done."""
+        print "writing data to %s (do not unplug) ..." % device.name
+        with self.syncs_lock:
+            if device in self.syncs:
+                raise ShifterError("sync of %s already in progress" % device.name)
+            verify = verify or device.inventory is not None
+            wanted = [playlist for playlist, want in zip(self.playlists, playlists_wanted) if want]
+            scribe = Scribe(device, label_callback, progress_callback, {"playlists": wanted, "verify": verify})
+            tmpdir = tempfile.mkdtemp(dir = self.tmpdir)
+            planner = threading.Thread(target = self.plan_sync,
+                                       args = (device, list(self.playlists), list(playlists_wanted), verify, scribe, tmpdir))
+            self.syncs[device] = (planner, scribe, tmpdir)
+        scribe.start()
+        planner.start()
+        return scribe
+
+    def plan_sync(self, device, playlists, playlists_wanted, verify, scribe, tmpdir):
+        """Queue up deletions, once the contents of every changed playlist are known, then copies for each in turn.
+Deleting first makes room on the device for what is copied."""
+        try:
+            paths = device.manifest.paths
+            deltas = {}                  # indexed by path id, of change in refcount
+            changed = []                 # of (playlist, source, files, ids) for wanted playlists to copy
+            unwanted = []
+            for i in range(len(playlists)):
+                if scribe.cancel_event.is_set():
+                    return
+                playlist = playlists[i]
+                if playlists_wanted[i]:
+                    source = self.playlist_cache.signature(playlist, device)
+                    if verify or not device.playlist_unchanged(playlist, source):
+                        files = self.playlist_cache.device_playlist(playlist, device)
+                        ids = paths.intern_set([devicepath_in_playlist for devicepath, devicepath_in_playlist, abspath in files])
+                        self.add_refcount_deltas(deltas, playlist, ids, device)
+                        changed.append((playlist, source, files, ids))
+                elif playlist in device.playlist_files:
+                    # unwanted playlist on device, so delete
+                    self.add_refcount_deltas(deltas, playlist, array('l'), device)
+                    unwanted.append(playlist)
+            self.queue_deletions(deltas, unwanted, device, scribe)
+            checked = set()              # of devicepaths already considered for copying
+            for playlist, source, files, ids in changed:
+                if scribe.cancel_event.is_set():
+                    return
+                self.queue_copies(playlist, source, files, ids, checked, device, scribe, tmpdir)
+            self.playlist_cache.save()
+        except (EnvironmentError, ShifterError) as e:
+            scribe.plan_failed(e)
+        finally:
+            scribe.plan_complete()
+
+    def add_refcount_deltas(self, deltas, playlist, ids, device):
+        """Add the change in refcount of each music file from playlist becoming ids."""
+        old = device.playlist_files.get(playlist, array('l'))
+        for i in sorted_difference(old, ids):
+            deltas[i] = deltas.get(i, 0) - 1
+        for i in sorted_difference(ids, old):
+            deltas[i] = deltas.get(i, 0) + 1
+
+    def queue_deletions(self, deltas, unwanted, device, scribe):
+        """Delete unwanted playlists, and music files no longer in any playlist."""
+        paths = device.manifest.paths
+        for i in sorted(deltas.keys()):
+            if deltas[i] < 0 and device.refcount(i) + deltas[i] <= 0:
+                scribe.queue_delete(device.musicfile_actual_path(paths.path(i)))
+        for playlist in unwanted:
+            scribe.queue_delete_playlist(device.playlist_file(playlist))
+
+    def queue_copies(self, playlist, source, files, ids, checked, device, scribe, tmpdir):
+        """Copy over any songs of playlist which are new or have changed, then the playlist itself."""
+        paths = device.manifest.paths
+        playlist_files = []
+        for devicepath, devicepath_in_playlist, abspath in files:
+            playlist_files.append(devicepath_in_playlist)
+            if devicepath in checked:
+                continue
+            checked.add(devicepath)
+            if not device.refcount(paths.get(devicepath_in_playlist)) or not device.has_file(devicepath) or \
+               device.source_changed(devicepath, abspath):
+                scribe.queue_copy(abspath, devicepath)
+
+        # copy playlist file if required, otherwise just remember where it came from
+        if ids != device.playlist_files.get(playlist):
+            m3uFile = os.path.join(tmpdir, playlist + ".m3u")
+            f = open(m3uFile, "w")
+            f.write("\n".join(playlist_files))
+            f.close()
+            scribe.queue_copy_playlist(m3uFile, device.playlist_file(playlist), source)
+        else:
+            scribe.queue_playlist_source(playlist, source)
+
+    def cancel_sync(self, device = None):
+        """Cancel the sync of device, or of all devices if None."""
+        with self.syncs_lock:
+            syncs = self.syncs.items()
+        for d, (planner, scribe, tmpdir) in syncs:
+            if device is None or d is device:
+                scribe.cancel()
 
     def sync_device_completed(self, progress, device):
         print "waiting for scribe"
-        self.scribe.join()
-        self.scribe = None
-        # update local state to reflect what we did.  This is non optimal, but works:
-        self.scan_device(device)
-        print "%d%% done, you may safely remove your device" % int(progress * 100)
+        with self.syncs_lock:
+            planner, scribe, tmpdir = self.syncs[device]
+        planner.join()
+        scribe.join()
+        with self.syncs_lock:
+            del self.syncs[device]
+        shutil.rmtree(tmpdir, True)
+        # scribe has brought device state up to date with what it did
+        self.update_playlists_on_device(device)
+        self.notify_device_storage_changed(scribe.usage)
+        print "%d%% done, you may safely remove %s" % (int(progress * 100), device.name)
 
     def cleanup(self):
         shutil.rmtree(self.tmpdir)
@@ -428,59 +1033,57 @@ Files are not copied if they are already in the device playlist.
         if hasattr(self, 'device_storage_callback'):
             self.device_storage_callback(usage)
 
-    def create_and_queue_playlist(self, playlist, playlist_name, device, scribe):
-        """Copy over any songs which have changed."""
-        new_playlist = playlist_name not in device.playlist_files.keys()
-        playlist_files = []
-
-        # queue copies for new files
-        for relpath,abspath in self.library.playlist_files(playlist):
-            if device.flatten:
-                devicepath = flattened_path(relpath)
-            else:
-                devicepath = relpath
-            devicepath_in_playlist = device.musicfile_playlist_path(devicepath)
-            playlist_files.append(devicepath_in_playlist)
-            if devicepath_in_playlist not in device.all_songs:
-                scribe.queue_copy(abspath, devicepath)
-
-        # determine whether we need to copy playlist itself, and queue deletions for obsolete files
-        if new_playlist:
-            need_to_copy_playlist = True
-        else:
-            playlist_files_set = set(playlist_files)
-            for musicfile in (device.playlist_files[playlist_name] - playlist_files_set):
-                scribe.queue_delete(device.musicfile_actual_path(musicfile))
-            need_to_copy_playlist = (playlist_files_set != device.playlist_files[playlist_name])
-
-        # copy playlist file if required
-        if need_to_copy_playlist:
-            m3uFile = os.path.join(self.tmpdir, playlist + ".m3u")
-            f = open(m3uFile, "w")
-            f.write("\n".join(playlist_files))
-            f.close
-            scribe.queue_copy_playlist(m3uFile, device.playlist_file(playlist_name))
 
-    def delete_playlist(self, playlist_name, device, scribe):
-        for musicfile in device.playlist_files[playlist_name]:
-            scribe.queue_delete(device.musicfile_actual_path(musicfile))
-        scribe.queue_delete_playlist(device.playlist_file(playlist_name))
+def describe_progress(stats):
+    """Return a short description of throughput and time remaining, from Scribe progress stats."""
+    if stats is None or stats["rate"] is None:
+        return ""
+    description = "%.1f MB/s" % (stats["rate"] / 1e6)
+    eta = stats["eta"]
+    if eta is not None:
+        description += ", %d:%02d remaining" % (int(eta) / 60, int(eta) % 60)
+    return description
 
+def unexpected_error(e):
+    """Return a ShifterError describing an exception a shifter let escape, such as EOFError from a dropped connection."""
+    if str(e):
+        return ShifterError("%s: %s" % (e.__class__.__name__, str(e)))
+    return ShifterError(e.__class__.__name__)
 
 class Scribe(threading.Thread):
-    """Deletes then copies data onto the device in a background thread.  Playlists are copied/deleted after their music files."""
+    """Deletes then copies data on the device in a background thread, as the plan arrives.
+
+Deletions come first in the plan, and are done before any copying, to
+make room on the device.  Music files are then copied as soon as they
+are planned, and each playlist after all music planned before it.
+Directories left empty are only pruned once all uploads are finished.
+
+Progress is weighted by bytes, and reported to progress_callback along
+with stats of bytes done and planned, throughput over the last
+THROUGHPUT_WINDOW seconds, and an estimate of seconds remaining once
+planning is complete.
+
+Copies are shared out across device.connections independent shifter sessions.
+If the shifter gains from it, a reader thread stages music into a local
+directory ahead of the uploads, so reading the library overlaps with
+sending to the device.
+"""
 
-    def __init__(self, device, label_callback, progress_callback):
+    def __init__(self, device, label_callback, progress_callback, trace_info = {}):
         super(Scribe, self).__init__()
         self.device = device
+        self.trace_info = trace_info
         self.label_callback = label_callback
         self.progress_callback = progress_callback
-        self.actions = []          # list of (src,dst), with src = None for deletions
-        self.copies = []           # list of (src,dst)
-        self.deletions = []        # list of dst
-        self.deleteRequired = {}             # indexed by dst, of deleteRequired
+        self.plan = Queue.Queue(PLAN_QUEUE_SIZE) # of plan items, None when complete
+        self.sources = {}          # indexed by playlist dst, of source signature
+        self.unchanged = {}        # indexed by playlist_name, of source signature to record once done
         self.n_copies = 0
+        self.n_music_copies = 0
         self.n_deletions = 0
+        self.error = None
+        self.usage = (None, None)  # device storage after the sync, if known
+        self.uploads_changed = threading.Condition()
         self.cancel_event = threading.Event()
 
     def cancel(self):
@@ -488,83 +1091,440 @@ class Scribe(threading.Thread):
 
     def queue_copy(self, src, dst):
         print("queue_copy(%s, %s)" % (src, dst))
-        self.n_copies += 1
-        self.copies.append((src,dst))
-        self.deleteRequired[dst] = False
+        self.plan.put(("copy", src, dst))
 
-    def queue_copy_playlist(self, src, dst):
+    def queue_copy_playlist(self, src, dst, source = None):
+        """Queue a playlist, which is only copied after all music queued before it."""
         print("queue_copy_playlist(%s, %s)" % (src, dst))
-        self.n_copies += 1
-        self.copies.append((src,dst))
+        self.plan.put(("playlist", src, dst, source))
+
+    def queue_playlist_source(self, playlist_name, source):
+        """Record the source of an unchanged playlist, once all copies are done."""
+        self.plan.put(("source", playlist_name, source))
 
     def queue_delete(self, dst):
         print("queue_delete(%s)" % dst)
-        if not self.deleteRequired.has_key(dst):
-            self.deleteRequired[dst] = True
-        self.n_deletions += 1
-        self.deletions.append(dst)
+        self.plan.put(("delete", dst))
 
     def queue_delete_playlist(self, dst):
         print("queue_delete_playlist(%s)" % dst)
-        if not self.deleteRequired.has_key(dst):
-            self.deleteRequired[dst] = True
-        self.n_deletions += 1
-        self.deletions.append(dst)
+        self.plan.put(("delete", dst))
+
+    def plan_failed(self, e):
+        print "planning failed", e
+        self.upload_failed(e)
+
+    def plan_complete(self):
+        self.plan.put(None)
 
     def check_cancelled(self):
         if not self.cancelled:
             self.cancelled = self.cancel_event.wait(0)
         return self.cancelled
 
+    def start_workers(self):
+        """Open as many extra shifter sessions as the device allows, and start an upload worker for each session."""
+        # each copy gets its own connection state when opened
+        for i in range(self.device.connections - 1):
+            shifter = copy.copy(self.device.shifter)
+            try:
+                shifter.open()
+            except ShifterError as e:
+                # a server may limit connections, so make do with what we have
+                print("failed to open extra connection, using %d: %s" % (len(self.shifters), str(e)))
+                break
+            self.shifters.append(shifter)
+            self.shifter_locks.append(threading.Lock())
+        self.jobs = Queue.Queue(2 * len(self.shifters))
+        for shifter, lock in zip(self.shifters, self.shifter_locks):
+            worker = threading.Thread(target = self.upload_worker, args = (shifter, lock))
+            worker.start()
+            self.workers.append(worker)
+        if self.device.shifter.read_ahead:
+            self.staging_dir = tempfile.mkdtemp(prefix = "qlsync-staging-")
+            self.n_stage_dirs = 0
+            self.n_staged = 0
+            self.staged_bytes = 0
+            self.staged_changed = threading.Condition()
+            self.reads = Queue.Queue(2 * len(self.shifters))
+            self.reader = threading.Thread(target = self.read_ahead)
+            self.reader.start()
+
+    def stop_workers(self):
+        """Wait for all uploads, and close the extra shifter sessions."""
+        if self.reader is not None:
+            # reader tells the workers when it's done
+            self.reads.put(None)
+            self.reader.join()
+            self.reader = None
+        else:
+            for worker in self.workers:
+                self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        if self.staging_dir is not None:
+            shutil.rmtree(self.staging_dir, True)
+            self.staging_dir = None
+        for shifter in self.shifters[1:]:
+            try:
+                shifter.close()
+            except ShifterError as e:
+                print "ignoring error", e
+        self.shifters = [self.device.shifter]
+        self.shifter_locks = self.shifter_locks[:1]
+
+    def dispatch(self, copies, after):
+        """Create any new destination directories, then hand copies to the upload workers."""
+        if not self.workers:
+            self.start_workers()
+        nbytes = 0
+        for src, dst in copies:
+            try:
+                nbytes += os.path.getsize(src)
+            except OSError:
+                # it'll fail soon enough
+                pass
+        self.uploads_changed.acquire()
+        self.bytes_planned += nbytes
+        self.uploads_changed.release()
+        self.create_dirs(copies)
+        if self.reader is not None:
+            self.reads.put((copies, after, nbytes))
+        else:
+            self.jobs.put((copies, after, nbytes, None))
+
+    def read_ahead(self):
+        """Stage music files from reads queue, passing them on to the upload workers, until a None job is found."""
+        while True:
+            job = self.reads.get()
+            if job is None:
+                break
+            copies, after, nbytes = job
+            if after is None and not self.check_cancelled():
+                staged = self.stage(copies, nbytes)
+            else:
+                staged = None
+            self.jobs.put((copies, after, nbytes, staged))
+        for worker in self.workers:
+            self.jobs.put(None)
+
+    def stage(self, copies, nbytes):
+        """Copy sources into the staging directory once there is room, returning (local sources, staging subdirectory, bytes)."""
+        self.staged_changed.acquire()
+        while self.n_staged > 0 and \
+              (self.n_staged + len(copies) > READ_AHEAD_FILES or self.staged_bytes + nbytes > READ_AHEAD_BYTES) and \
+              not self.check_cancelled():
+            # time out to notice cancellation
+            self.staged_changed.wait(1)
+        self.n_staged += len(copies)
+        self.staged_bytes += nbytes
+        self.staged_changed.release()
+        # keep basenames, so shifters can upload a batch into its directory in one go
+        self.n_stage_dirs += 1
+        stage_dir = os.path.join(self.staging_dir, str(self.n_stage_dirs))
+        srcs = []
+        try:
+            os.mkdir(stage_dir)
+            for src, dst in copies:
+                staged = os.path.join(stage_dir, os.path.basename(dst))
+                shutil.copyfile(src, staged)
+                srcs.append(staged)
+        except (IOError, OSError) as e:
+            print("staging failed, reading directly: %s" % str(e))
+            srcs = [src for src, dst in copies]
+        return (srcs, stage_dir, nbytes)
+
+    def unstage(self, n, staged):
+        """Free the staging space taken by n files."""
+        srcs, stage_dir, nbytes = staged
+        shutil.rmtree(stage_dir, True)
+        self.staged_changed.acquire()
+        self.n_staged -= n
+        self.staged_bytes -= nbytes
+        self.staged_changed.notify_all()
+        self.staged_changed.release()
+
+    def upload_worker(self, shifter, lock):
+        """Upload files from jobs queue until a None job is found."""
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            copies, after, nbytes, staged = job
+            try:
+                self.upload_job(shifter, lock, copies, after, nbytes, staged)
+            except ShifterError as e:
+                self.upload_failed(e)
+            except Exception as e:
+                # a dropped connection may raise anything, but the worker must
+                # carry on draining the queue, or the scribe blocks on it
+                self.upload_failed(unexpected_error(e))
+            finally:
+                if staged is not None:
+                    self.unstage(len(copies), staged)
+
+    def upload_job(self, shifter, lock, copies, after, nbytes, staged):
+        if self.check_cancelled():
+            # drain the queue
+            return
+        if after is not None and not self.wait_for_music_uploads(after):
+            return
+        dstRoot = self.device.musicdir
+        if staged is not None:
+            srcs = staged[0]
+        else:
+            srcs = [src for src, dst in copies]
+        dstCopies = [(srcs[i], os.path.join(dstRoot, copies[i][1])) for i in range(len(copies))]
+        for src, dstFile in dstCopies:
+            print("uploadfile %s" % dstFile)
+        with lock:
+            shifter.uploadfiles(dstCopies)
+        self.upload_completed(copies, after is None, nbytes)
+
+    def wait_for_music_uploads(self, n):
+        """Wait until n music files have been uploaded, returning False if cancelled meanwhile."""
+        self.uploads_changed.acquire()
+        while self.n_music_uploaded < n and not self.check_cancelled():
+            # time out to notice cancellation
+            self.uploads_changed.wait(1)
+        self.uploads_changed.release()
+        return not self.cancelled
+
+    def upload_completed(self, copies, is_music, nbytes):
+        self.uploads_changed.acquire()
+        n = len(copies)
+        for src, dst in copies:
+            if is_music:
+                self.device.record_upload(dst, src)
+            else:
+                self.device.record_playlist_upload(dst, src, self.sources.get(dst))
+        self.i_copy += n
+        if is_music:
+            self.n_music_uploaded += n
+        self.bytes_done += nbytes
+        self.samples.append((time.time(), self.bytes_done))
+        progress, stats = self.progress()
+        self.uploads_changed.notify_all()
+        self.uploads_changed.release()
+        self.progress_callback(progress, False, stats)
+
+    def progress(self):
+        """Return the fraction of work done, out of what has been planned so far, and stats."""
+        now = time.time()
+        # throughput over the window, keeping at least one earlier sample
+        while len(self.samples) > 2 and self.samples[1][0] < now - THROUGHPUT_WINDOW:
+            self.samples.pop(0)
+        t0, bytes0 = self.samples[0]
+        t1, bytes1 = self.samples[-1]
+        rate = None
+        if t1 > t0:
+            rate = (bytes1 - bytes0) / (t1 - t0)
+        total = self.bytes_planned + self.n_deletions * DELETE_WEIGHT_BYTES
+        done = self.bytes_done + self.i_delete * DELETE_WEIGHT_BYTES
+        eta = None
+        if self.planned and rate:
+            eta = (total - done) / rate
+        stats = {
+            "files_done": self.i_copy,
+            "files_planned": self.n_copies,
+            "deletions_done": self.i_delete,
+            "deletions_planned": self.n_deletions,
+            "bytes_done": self.bytes_done,
+            "bytes_planned": self.bytes_planned,
+            "rate": rate,
+            "eta": eta,
+            "elapsed": now - self.start_time,
+        }
+        if total == 0:
+            return (0.0, stats)
+        return (done * 1.0 / total, stats)
+
+    def delete_files(self, dsts):
+        """Delete all files which are no longer required, in batches, noting directories which may become empty."""
+        dstRoot = self.device.musicdir
+        delDirs = self.pruned_dirs
+        for i in range(0, len(dsts), DELETE_BATCH_SIZE):
+            if self.check_cancelled():
+                break
+            batch = [os.path.join(dstRoot, dst) for dst in dsts[i:i + DELETE_BATCH_SIZE]]
+            for dstFile in batch:
+                self.i_delete += 1
+                print("removefile %d of %d: %s" % (self.i_delete, self.n_deletions, dstFile))
+                # parent directories may become empty too
+                dstDir = os.path.dirname(dstFile)
+                while dstDir.startswith(dstRoot + "/") and dstDir not in delDirs:
+                    delDirs.add(dstDir)
+                    dstDir = os.path.dirname(dstDir)
+            try:
+                with self.shifter_locks[0]:
+                    errors = self.device.shifter.removefiles(batch)
+            except ShifterError as e:
+                # the batch stays in the manifest, so is deleted next time
+                self.i_delete -= len(batch)
+                self.upload_failed(e)
+                break
+            except Exception as e:
+                self.i_delete -= len(batch)
+                self.upload_failed(unexpected_error(e))
+                break
+            for e in errors:
+                # we don't care if this fails
+                print "ignoring error", e
+            for dst in dsts[i:i + DELETE_BATCH_SIZE]:
+                self.device.record_deletion(dst)
+            self.uploads_changed.acquire()
+            progress, stats = self.progress()
+            self.uploads_changed.release()
+            self.progress_callback(progress, False, stats)
+
+    def prune_dirs(self):
+        """Remove directories left empty by deletions, which mustn't be done while uploads may need them."""
+        if self.pruned_dirs and not self.check_cancelled():
+            try:
+                with self.shifter_locks[0]:
+                    self.device.shifter.removedirs_if_empty(self.pruned_dirs)
+            except ShifterError as e:
+                self.upload_failed(e)
+            except Exception as e:
+                self.upload_failed(unexpected_error(e))
+
+    def create_dirs(self, copies):
+        """Create destination directories not already created or known to exist."""
+        dstRoot = self.device.musicdir
+        dstDirs = set([os.path.dirname(os.path.join(dstRoot, dst)) for src, dst in copies]) - self.created_dirs
+        if not dstDirs:
+            return
+        self.created_dirs |= dstDirs
+        print("makedirs_all %d directories" % len(dstDirs))
+        try:
+            with self.shifter_locks[0]:
+                self.device.shifter.makedirs_all(dstDirs)
+        except ShifterError as e:
+            self.upload_failed(e)
+        except Exception as e:
+            self.upload_failed(unexpected_error(e))
+
+    def upload_failed(self, e):
+        """Stop everything after the first upload failure."""
+        print "upload failed", e
+        self.uploads_changed.acquire()
+        if self.error is None:
+            self.error = e
+        self.cancel()
+        self.uploads_changed.notify_all()
+        self.uploads_changed.release()
+
     def run(self):
-        """Copy all wanted files, and delete unwanted."""
+        """Copy all wanted files as they are planned, then delete unwanted."""
         self.cancelled = False
-        progress = 0.0
+        self.pruned_dirs = set()
+        self.i_copy = 0
+        self.i_delete = 0
+        self.n_music_uploaded = 0
+        self.bytes_planned = 0
+        self.bytes_done = 0
+        self.planned = False
+        self.start_time = time.time()
+        self.samples = [(self.start_time, 0)] # of (time, bytes_done)
 
         # let GUI know what we're up to
-        self.label_callback(str(self.n_copies) + " files to copy and " + str(self.n_deletions) + " to delete")
+        self.label_callback("planning sync")
 
         # go for it
-        self.device.shifter.open()
-        dstRoot = self.device.musicdir
-        delDirs = {}
-        i_copy = 0
-        i_delete = 0
-        # deletions
-        for dst in self.deletions:
-            if self.check_cancelled():
-                break
-            dstFile = os.path.join(dstRoot, dst)
-            dstDir = os.path.dirname(dstFile)
-            if self.deleteRequired.has_key(dst) and self.deleteRequired[dst]:
-                i_delete += 1
-                print "removefile", i_delete, "of", self.n_deletions, ": ", dstFile
-                delDirs[dstDir] = True
-                try:
-                    self.device.shifter.removefile(dstFile)
-                except ShifterError as e:
-                    # we don't care if this fails
-                    print "ignoring error", e
-                    pass
-                progress = i_delete * 1.0 / (self.n_copies + self.n_deletions)
-                self.progress_callback(progress)
-        for dstDir in delDirs.keys():
-            if self.check_cancelled():
-                break
-            self.device.shifter.removedir_if_empty(dstDir)
-        for src,dst in self.copies:
+        self.device.instrument("sync", self.trace_info)
+        try:
+            self.device.shifter.open()
+        except ShifterError as e:
+            self.upload_failed(e)
+            for item in iter(self.plan.get, None):
+                # let the planner finish
+                pass
+            self.device.uninstrument("sync")
+            self.label_callback("sync failed: " + str(self.error))
+            self.progress_callback(0.0, True, self.progress()[1]) # complete
+            return
+        self.shifters = [self.device.shifter]
+        self.shifter_locks = [threading.Lock()]
+        self.workers = []
+        self.reader = None
+        self.staging_dir = None
+        if self.device.inventory is not None:
+            self.created_dirs = self.device.inventory_dirs()
+        else:
+            self.created_dirs = set()
+        batch_size = self.device.shifter.upload_batch_size
+        batch = []
+        deletions = []
+        for item in iter(self.plan.get, None):
             if self.check_cancelled():
-                break
-            dstFile = os.path.join(dstRoot, dst)
-            dstDir = os.path.dirname(dstFile)
-            if src is not None:
-                i_copy += 1
-                print "uploadfile", i_copy, "of", self.n_copies, ": ", dstFile
-                self.device.shifter.makedirs(dstDir)
-                self.device.shifter.uploadfile(src, dstFile)
-                progress = (self.n_deletions + i_copy) * 1.0 / (self.n_copies + self.n_deletions)
-                self.progress_callback(progress)
-        if not self.cancelled:
+                # drain the plan, so the planner finishes
+                continue
+            kind = item[0]
+            if kind != "delete" and deletions:
+                # all deletions come before any copy, so make room now
+                self.delete_files(deletions)
+                deletions = []
+            if kind == "copy":
+                src, dst = item[1:]
+                # batch up music files for the same directory
+                if batch and (len(batch) == batch_size or os.path.dirname(dst) != os.path.dirname(batch[0][1])):
+                    self.dispatch(batch, None)
+                    batch = []
+                self.n_copies += 1
+                self.n_music_copies += 1
+                batch.append((src, dst))
+            elif kind == "playlist":
+                src, dst, source = item[1:]
+                if batch:
+                    self.dispatch(batch, None)
+                    batch = []
+                self.n_copies += 1
+                self.sources[dst] = source
+                self.dispatch([(src, dst)], self.n_music_copies)
+            elif kind == "source":
+                playlist_name, source = item[1:]
+                self.unchanged[playlist_name] = source
+            elif kind == "delete":
+                self.n_deletions += 1
+                deletions.append(item[1])
+        if batch and not self.check_cancelled():
+            self.dispatch(batch, None)
+        if deletions:
+            # nothing to copy
+            self.delete_files(deletions)
+        self.planned = True
+        self.label_callback(str(self.n_copies) + " files to copy and " + str(self.n_deletions) + " to delete")
+        # finish uploading first, so pruning can't remove a directory which is about to get new files
+        self.stop_workers()
+        self.prune_dirs()
+        if not self.check_cancelled():
+            # all music is there, so unchanged playlists are as good as synced
+            for playlist_name, source in self.unchanged.items():
+                self.device.record_playlist_source(playlist_name, source)
+        if self.n_copies + self.n_deletions > 0 or self.device.manifest.dirty:
+            # record whatever we actually managed to do
+            try:
+                self.device.write_manifest(self.device.shifter)
+                self.device.update_state(self.device.shifter)
+            except ShifterError as e:
+                print "failed to write manifest", e
+                self.device.use_manifest_playlists()
+                self.device.save_state(None)
+        try:
+            self.usage = self.device.shifter.get_storage_space(self.device.musicdir)
+        except ShifterError as e:
+            print "failed to get storage space", e
+        if self.error is not None:
+            self.label_callback("sync failed: " + str(self.error))
+        progress, stats = self.progress()
+        if not self.check_cancelled():
             progress = 1
-        self.device.flush()
-        self.progress_callback(progress, True) # complete
+        try:
+            self.device.flush()
+        except ShifterError as e:
+            print "failed to flush", e
+        self.device.uninstrument("sync")
+        print("%d files (%d bytes) copied and %d deleted in %.1fs" %
+              (stats["files_done"], stats["bytes_done"], stats["deletions_done"], stats["elapsed"]))
+        self.progress_callback(progress, True, stats) # complete
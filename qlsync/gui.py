@@ -6,7 +6,7 @@
 
 from gi.repository import GObject, Gtk, Gdk
 
-from qlsync.engine import Device, Settings, Syncer
+from qlsync.engine import Device, Settings, Syncer, describe_progress
 from qlsync.shifters_gui import ShifterSelectorWidget
 from qlsync.shifters import ShifterError, KILO
 
@@ -26,6 +26,9 @@ def format_gigabytes(g):
     return formatted
             
 class SettingsDialog(object):
+
+    DEFAULT_CONNECTIONS = 1
+
     def __init__(self, parent, settings, error_fn):
         self.settings = settings
         self.window = Gtk.Dialog("Settings", parent, Gtk.DialogFlags.MODAL)
@@ -58,6 +61,14 @@ class SettingsDialog(object):
         self.deviceTable.attach(self.deviceFlattenButton, left_attach=1, right_attach=2, top_attach=2, bottom_attach=3)
         self.deviceFlattenButton.show()
 
+        self.deviceConnectionsLabel = Gtk.Label("Connections")
+        self.deviceConnectionsEntry = Gtk.Entry()
+        self.deviceConnectionsEntry.set_max_length(2)
+        self.deviceTable.attach(self.deviceConnectionsLabel, left_attach=0, right_attach=1, top_attach=3, bottom_attach=4)
+        self.deviceTable.attach(self.deviceConnectionsEntry, left_attach=1, right_attach=2, top_attach=3, bottom_attach=4)
+        self.deviceConnectionsLabel.show()
+        self.deviceConnectionsEntry.show()
+
         self.layout.pack_start(self.deviceTable, expand=True, fill=True, padding=0)
         self.deviceTable.show()
 
@@ -109,6 +120,7 @@ class SettingsDialog(object):
             self.deviceNameEntry.set_text(device.name)
             self.deviceMusicdirEntry.set_text(device.musicdir)
             self.deviceFlattenButton.set_active(device.flatten)
+            self.deviceConnectionsEntry.set_text(str(device.connections))
             self.shifterSettings.display(device.shifter)
         else:
             self.clear()
@@ -117,7 +129,8 @@ class SettingsDialog(object):
         self.deviceNameEntry.set_text("")
         self.deviceMusicdirEntry.set_text("")
         self.deviceFlattenButton.set_active(False)
-        
+        self.deviceConnectionsEntry.set_text(str(SettingsDialog.DEFAULT_CONNECTIONS))
+
         self.shifterSettings.clear()
 
     def create_device(self):
@@ -125,7 +138,11 @@ class SettingsDialog(object):
         name = self.deviceNameEntry.get_text().strip()
         musicdir = self.deviceMusicdirEntry.get_text().strip()
         flatten = self.deviceFlattenButton.get_active()
-        device = Device(name, musicdir, shifter, flatten)
+        try:
+            connections = max(1, int(self.deviceConnectionsEntry.get_text()))
+        except ValueError:
+            connections = SettingsDialog.DEFAULT_CONNECTIONS
+        device = Device(name, musicdir, shifter, flatten, connections)
         return device
 
     def delete_callback(self, data=None):
@@ -190,6 +207,11 @@ class MainWindow(Gtk.Window):
         self.syncButton.connect_object("clicked", self.sync_callback, self)
         self.hbox.add(self.syncButton)
 
+        # Verify option, to check every song rather than just changed playlists
+        self.verifyButton = Gtk.CheckButton("Verify")
+        self.verifyButton.set_tooltip_text("Check every song in every playlist, not just playlists changed since last sync")
+        self.hbox.add(self.verifyButton)
+
         # Storage space bar
         self.storage_space_bar = Gtk.ProgressBar()
         self.hbox.add(self.storage_space_bar)
@@ -304,6 +326,8 @@ class MainWindow(Gtk.Window):
 
             # progress bar
             self.progress_bar = Gtk.ProgressBar()
+            self.progress_bar.set_show_text(True)
+            self.progress_bar.set_text("")
             progress_vbox.pack_start(self.progress_bar, expand=True, fill=True, padding=0)
             self.progress_bar.show()
 
@@ -323,12 +347,13 @@ class MainWindow(Gtk.Window):
                 self.syncer.sync_device(device,
                                         self.playlists_wanted,
                                         self.update_progress_label_callback,
-                                        self.update_progress_callback)
+                                        self.update_progress_callback,
+                                        self.verifyButton.get_active())
             except ShifterError as e:
                 self.show_error_message(str(e))
 
     def cancel_sync_callback(self, widget):
-        self.syncer.cancel_sync()
+        self.syncer.cancel_sync(self.settings.devices[self.settings.currentDeviceIndex])
 
     def update_progress_label_callback(self, text):
         GObject.idle_add(self.update_progress_label, text)
@@ -336,11 +361,12 @@ class MainWindow(Gtk.Window):
     def update_progress_label(self, text):
         self.progress_label.set_text(text)
 
-    def update_progress_callback(self, fraction, done=False):
-        GObject.idle_add(self.update_progress, fraction, done)
+    def update_progress_callback(self, fraction, done=False, stats=None):
+        GObject.idle_add(self.update_progress, fraction, done, stats)
 
-    def update_progress(self, fraction, done=False):
+    def update_progress(self, fraction, done=False, stats=None):
         self.progress_bar.set_fraction(fraction)
+        self.progress_bar.set_text(describe_progress(stats))
         if done:
             device = self.settings.devices[self.settings.currentDeviceIndex]
             self.syncer.sync_device_completed(fraction, device)
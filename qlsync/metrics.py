@@ -0,0 +1,140 @@
+# Copyright 2012 Simon Guest
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+
+import copy
+import json
+import math
+import os
+import os.path
+import threading
+import time
+
+# where reports are written, one per device and activity
+METRICS_DIR = os.path.expanduser("~/.cache/qlsync/metrics")
+
+# smallest latency histogram bucket, in milliseconds
+MIN_BUCKET_MS = 1.0 / 64
+
+def latency_bucket(seconds):
+    """Return the upper bound in milliseconds of the power of two histogram bucket for seconds."""
+    ms = seconds * 1000.0
+    if ms <= MIN_BUCKET_MS:
+        return MIN_BUCKET_MS
+    return 2.0 ** math.ceil(math.log(ms, 2))
+
+def file_bytes(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def lines_bytes(lines):
+    return sum([len(line) for line in lines])
+
+# for each shifter method moving data, how many bytes a call moved, from (args, result)
+BYTES_MOVED = {
+    'uploadfile': lambda args, result: file_bytes(args[0]),
+    'uploadfiles': lambda args, result: sum([file_bytes(src) for src, dst in args[0]]),
+    'readlines': lambda args, result: lines_bytes(result),
+    'readlines_many': lambda args, result: sum([lines_bytes(lines) for lines in result.values()]),
+}
+
+class Metrics(object):
+    """Count, total time, bytes and latency histogram for each shifter method called."""
+
+    def __init__(self):
+        self.methods = {}                # indexed by method name, of dict of stats
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+
+    def record(self, method, seconds, nbytes = 0, failed = False):
+        with self.lock:
+            stats = self.methods.get(method)
+            if stats is None:
+                stats = {"count": 0, "failures": 0, "seconds": 0.0, "max_seconds": 0.0, "bytes": 0, "histogram": {}}
+                self.methods[method] = stats
+            stats["count"] += 1
+            if failed:
+                stats["failures"] += 1
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["bytes"] += nbytes
+            bucket = "%g" % latency_bucket(seconds)
+            stats["histogram"][bucket] = stats["histogram"].get(bucket, 0) + 1
+
+    def report(self):
+        """Return the metrics as a dict, with derived mean latency and throughput."""
+        with self.lock:
+            methods = copy.deepcopy(self.methods)
+        for stats in methods.values():
+            stats["mean_seconds"] = stats["seconds"] / stats["count"]
+            if stats["bytes"] and stats["seconds"] > 0:
+                stats["bytes_per_second"] = stats["bytes"] / stats["seconds"]
+        return {
+            "elapsed": time.time() - self.start_time,
+            "histogram_unit": "ms, upper bound",
+            "methods": methods,
+        }
+
+    def dump(self, device_name, activity):
+        """Write the report as JSON, for device_name and activity (scan or sync)."""
+        try:
+            if not os.path.isdir(METRICS_DIR):
+                os.makedirs(METRICS_DIR)
+            path = os.path.join(METRICS_DIR, "%s-%s.json" % (device_name.replace("/", "_"), activity))
+            with open(path, 'w') as f:
+                json.dump(self.report(), f, indent = 2, sort_keys = True)
+        except (IOError, OSError) as e:
+            print("save metrics failed: %s" % str(e))
+
+class InstrumentedShifter(object):
+    """Wrap any shifter, recording metrics of each public method call.
+
+Copying the wrapper copies the wrapped shifter, so extra sessions are
+independent but share the metrics.  Pickling it pickles just the
+wrapped shifter, so it never ends up in saved settings.
+
+If given a trace recorder, every call is also written to the trace,
+tagged with the session it was made on.
+"""
+
+    def __init__(self, shifter, metrics, recorder = None):
+        self.shifter = shifter
+        self.metrics = metrics
+        self.recorder = recorder
+        self.session = recorder.new_session() if recorder is not None else None
+
+    def __getattr__(self, name):
+        attr = getattr(self.shifter, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        def instrumented(*args, **kwargs):
+            t0 = time.time()
+            try:
+                result = attr(*args, **kwargs)
+            except BaseException as e:
+                # ShifterError is a BaseException
+                elapsed = time.time() - t0
+                self.metrics.record(name, elapsed, failed = True)
+                if self.recorder is not None:
+                    self.recorder.record(self.session, name, args, kwargs, t0, elapsed, error = e)
+                raise
+            elapsed = time.time() - t0
+            moved = BYTES_MOVED.get(name)
+            self.metrics.record(name, elapsed, moved(args, result) if moved else 0)
+            if self.recorder is not None:
+                self.recorder.record(self.session, name, args, kwargs, t0, elapsed, result)
+            return result
+        return instrumented
+
+    def __copy__(self):
+        return InstrumentedShifter(copy.copy(self.shifter), self.metrics, self.recorder)
+
+    def __reduce__(self):
+        return self.shifter.__reduce_ex__(2)
+
+    def __str__(self):
+        return str(self.shifter)
@@ -4,12 +4,20 @@
 # it under the terms of the GNU General Public License version 2 as
 # published by the Free Software Foundation
 
+import calendar
 import filecmp
-import ftplib
 import os
-import paramiko
+import random
 import shutil
+import stat
 import subprocess
+import threading
+import time
+
+# Transport libraries are only imported when their shifter is opened,
+# so nobody pays for transports they don't use.
+ftplib = None
+paramiko = None
 
 # decimal not binary for disk drives and FLASH memory,
 # see http://en.wikipedia.org/wiki/Gigabyte
@@ -17,6 +25,18 @@ KILO = 1000
 MEGA = KILO * KILO
 GIGA = MEGA * KILO
 
+# FTP commands sent before reading any replies
+FTP_PIPELINE_WINDOW = 32
+
+# paths per adb shell command, to stay well inside command line limits
+ADB_MAX_ARGS = 64
+
+# SFTP files read at once
+SFTP_READ_WINDOW = 16
+
+# SFTP requests sent before waiting for a reply, when pipelining
+SFTP_PIPELINE_WINDOW = 32
+
 def parse_as_gigabytes(s):
     try:
         x = float(s[:-1])
@@ -39,8 +59,103 @@ class ShifterError(BaseException):
     def __str__(self):
         return "Error: " + self.message
 
-class FilesystemShifter(object):
+class KnownDirs(object):
+    """Directories known to exist on the device."""
+    def __init__(self):
+        self.dirs = set()
+
+    def __contains__(self, dst):
+        return os.path.normpath(dst) in self.dirs
+
+    def add(self, dst):
+        """Record that dst exists, and therefore all its ancestors too."""
+        dst = os.path.normpath(dst)
+        while dst not in self.dirs and dst not in ('', '/', '.'):
+            self.dirs.add(dst)
+            dst = os.path.dirname(dst)
+
+    def discard(self, dst):
+        """Forget dst and everything below it."""
+        dst = os.path.normpath(dst)
+        prefix = dst + '/'
+        self.dirs = set(d for d in self.dirs if d != dst and not d.startswith(prefix))
+
+class Shifter(object):
+    """Base class for shifters, providing batch operations in terms of single ones.
+
+Subclasses implement makedirs_uncached, which is only called for
+directories not already known to exist during this session.
+"""
+
+    # number of files worth passing to uploadfiles in one go
+    upload_batch_size = 1
+
+    # whether uploads gain from sources being read ahead into local staging
+    read_ahead = True
+
+    # state of an open session, which is neither saved in settings nor copied
+    session_attrs = ('known_dirs',)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for attr in self.session_attrs:
+            state.pop(attr, None)
+        return state
+
+    def open(self):
+        """Start a session."""
+        self.known_dirs = KnownDirs()
+
+    def makedirs(self, dst):
+        """Ensure directory dst exists, creating parents as required."""
+        if dst not in self.known_dirs:
+            self.makedirs_uncached(dst)
+            self.known_dirs.add(dst)
+
+    def getmtimes(self, dsts):
+        """Return list of modification times for dsts, with None for any which are missing or unknown."""
+        return [self.getmtime(dst) for dst in dsts]
+
+    def makedirs_all(self, dsts):
+        """Ensure all directories in dsts exist."""
+        # parents sort before their children
+        for dst in sorted(dsts):
+            self.makedirs(dst)
+
+    def uploadfiles(self, copies):
+        """Upload list of (src,dst)."""
+        for src, dst in copies:
+            self.uploadfile(src, dst)
+
+    def readlines_many(self, srcs):
+        """Return dict of lines for each file in srcs, indexed by src."""
+        contents = {}
+        for src in srcs:
+            contents[src] = self.readlines(src)
+        return contents
+
+    def removefiles(self, dsts):
+        """Remove all files in dsts, returning a list of ShifterError for any which failed."""
+        errors = []
+        for dst in dsts:
+            try:
+                self.removefile(dst)
+            except ShifterError as e:
+                errors.append(e)
+        return errors
+
+    def removedirs_if_empty(self, dsts):
+        """Remove whichever directories in dsts are empty, deepest first."""
+        # children sort after their parents
+        for dst in sorted(dsts, reverse = True):
+            self.removedir_if_empty(dst)
+
+class FilesystemShifter(Shifter):
     """Use the filesystem to transfer files."""
+
+    # staging would just be an extra copy through the local disk
+    read_ahead = False
+
     def __init__(self):
         pass
 
@@ -48,12 +163,19 @@ class FilesystemShifter(object):
         return "FilesystemShifter"
 
     def open(self):
-        pass
+        super(FilesystemShifter, self).open()
 
     def path_exists(self, dst):
         return os.path.exists(dst)
 
-    def makedirs(self, dst):
+    def getmtime(self, dst):
+        """Return modification time of dst, or None if missing."""
+        try:
+            return int(os.stat(dst).st_mtime)
+        except OSError:
+            return None
+
+    def makedirs_uncached(self, dst):
         try:
             if not self.path_exists(dst):
                 os.makedirs(dst)
@@ -84,6 +206,7 @@ class FilesystemShifter(object):
             raise ShifterError(str(e))
 
     def removedir_if_empty(self, dst):
+        self.known_dirs.discard(dst)
         try:
             os.rmdir(dst)
         except OSError:
@@ -96,8 +219,27 @@ class FilesystemShifter(object):
             files = os.listdir(dst)
         except OSError as e:
              raise ShifterError(str(e))
+        self.known_dirs.add(dst)
         return files
 
+    def walk_stat(self, dst):
+        """Return dict of (size, mtime) for all files below dst, indexed by path relative to dst."""
+        if not os.path.isdir(dst):
+            raise ShifterError("no such directory %s" % dst)
+        inventory = {}
+        for root, dirs, files in os.walk(dst):
+            self.known_dirs.add(root)
+            for f in files:
+                path = os.path.join(root, f)
+                try:
+                    s = os.stat(path)
+                except OSError:
+                    # vanished underneath us
+                    continue
+                if stat.S_ISREG(s.st_mode):
+                    inventory[os.path.relpath(path, dst)] = (s.st_size, int(s.st_mtime))
+        return inventory
+
     def get_storage_space(self, dst):
         """Disk space (avail, total) in GB."""
         try:
@@ -116,33 +258,64 @@ class FilesystemShifter(object):
     def close(self):
         pass
 
-class FtpShifter(object):
+class FtpShifter(Shifter):
     """Use ftp to transfer files."""
-    def __init__(self, host, user, password):
+
+    # default for shifters pickled before the port was configurable
+    port = 21
+
+    session_attrs = Shifter.session_attrs + ('ftp',)
+
+    def __init__(self, host, user, password, port = 21):
         self.host = host
         self.user = user
         self.password = password
+        self.port = port
 
     def __str__(self):
         return "FtpShifter(host=" + self.host + ",user=" + self.user + ")"
 
     def open(self):
+        global ftplib
+        import ftplib
+        super(FtpShifter, self).open()
         try:
-            self.ftp = ftplib.FTP(self.host, self.user, self.password)
+            self.ftp = ftplib.FTP()
+            self.ftp.connect(self.host, self.port)
+            self.ftp.login(self.user, self.password)
         except ftplib.all_errors as e:
             raise ShifterError(str(e))
 
     def path_exists(self, dst):
         d = os.path.dirname(dst)
         f = os.path.basename(dst)
+        if dst in self.known_dirs:
+            return True
         try:
             files = self.ftp.nlst(d)
         except ftplib.all_errors as e:
             raise ShifterError(str(e))
         # may be relative or absolute, so cope with both
-        return (f in files) or (dst in files)
+        found = (f in files) or (dst in files)
+        # some servers (e.g. vsftpd) list a missing directory as empty, so only a non-empty listing shows d exists
+        if d != '' and (found or files):
+            self.known_dirs.add(d)
+        return found
 
-    def makedirs(self, dst):
+    def getmtime(self, dst):
+        """Return modification time of dst, or None if missing or the server won't say."""
+        try:
+            resp = self.ftp.sendcmd("MDTM " + dst)
+        except ftplib.error_perm:
+            return None
+        except ftplib.all_errors as e:
+            raise ShifterError(str(e))
+        try:
+            return calendar.timegm(time.strptime(resp.split()[1][:14], "%Y%m%d%H%M%S"))
+        except (IndexError, ValueError):
+            return None
+
+    def makedirs_uncached(self, dst):
         if self.path_exists(dst):
             pass
         else:
@@ -154,6 +327,46 @@ class FtpShifter(object):
             except ftplib.all_errors as e:
                 raise ShifterError(str(e))
 
+    def makedirs_all(self, dsts):
+        """Ensure all directories in dsts exist, sending MKDs without waiting for each reply."""
+        missing = set()
+        for dst in dsts:
+            while dst not in ('', '/') and dst not in self.known_dirs and dst not in missing:
+                missing.add(dst)
+                dst = os.path.dirname(dst)
+        missing = sorted(missing)
+        failed = []
+        for dst, error in zip(missing, self.pipeline("MKD", missing)):
+            if error is None:
+                self.known_dirs.add(dst)
+            else:
+                failed.append(dst)
+        # most likely these exist already
+        for dst in failed:
+            if not self.path_exists(dst):
+                raise ShifterError("failed to create directory " + dst)
+            self.known_dirs.add(dst)
+
+    def pipeline(self, command, dsts):
+        """Send command for each of dsts without waiting for each reply, returning list of ftplib error or None.
+Every reply in a window is read, even after a failure, so later replies aren't taken for those of later commands."""
+        errors = []
+        try:
+            # a bounded window, so the server can't block on writing replies
+            for i in range(0, len(dsts), FTP_PIPELINE_WINDOW):
+                window = dsts[i:i + FTP_PIPELINE_WINDOW]
+                for dst in window:
+                    self.ftp.putcmd("%s %s" % (command, dst))
+                for dst in window:
+                    try:
+                        self.ftp.getresp()
+                        errors.append(None)
+                    except (ftplib.error_perm, ftplib.error_temp, ftplib.error_reply) as e:
+                        errors.append(e)
+        except ftplib.all_errors as e:
+            raise ShifterError(str(e))
+        return errors
+
     def uploadfile(self, src, dst):
         f = open(src, "r")
         try:
@@ -176,7 +389,12 @@ class FtpShifter(object):
         except ftplib.all_errors as e:
             raise ShifterError(str(e))
 
+    def removefiles(self, dsts):
+        """Remove all files in dsts, sending DELEs without waiting for each reply."""
+        return [ShifterError(str(e)) for e in self.pipeline("DELE", dsts) if e is not None]
+
     def removedir_if_empty(self, dst):
+        self.known_dirs.discard(dst)
         try:
             self.ftp.rmd(dst)
         except ftplib.error_perm:
@@ -185,15 +403,66 @@ class FtpShifter(object):
         except ftplib.all_errors as e:
             raise ShifterError(str(e))
 
+    def removedirs_if_empty(self, dsts):
+        """Remove whichever directories in dsts are empty, deepest first, sending RMDs without waiting for each reply."""
+        dsts = sorted(dsts, reverse = True)
+        for dst in dsts:
+            self.known_dirs.discard(dst)
+        # failures are for directories which weren't empty, so ignore
+        self.pipeline("RMD", dsts)
+
     def ls(self, dst):
         """Return directory listing, with relative paths."""
         try:
             maybe_abs_files = self.ftp.nlst(dst)
         except ftplib.all_errors as e:
             raise ShifterError(str(e))
+        if maybe_abs_files:
+            # some servers list a missing directory as empty, so only a non-empty one is known to exist
+            self.known_dirs.add(dst)
         # may be relative or absolute, so cope with both
         return [ os.path.basename(x) for x in maybe_abs_files ]
 
+    def mlsd(self, dst):
+        """Return list of (name, facts) for directory dst."""
+        lines = []
+        try:
+            self.ftp.retrlines("MLSD " + dst, lines.append)
+        except ftplib.all_errors as e:
+            raise ShifterError(str(e))
+        entries = []
+        for line in lines:
+            facts_string, sep, name = line.partition(' ')
+            facts = {}
+            for fact in facts_string.rstrip(';').split(';'):
+                key, sep, value = fact.partition('=')
+                facts[key.lower()] = value
+            entries.append((name, facts))
+        return entries
+
+    def walk_stat(self, dst):
+        """Return dict of (size, mtime) for all files below dst, indexed by path relative to dst."""
+        inventory = {}
+        pending = ['']
+        while pending:
+            rel = pending.pop()
+            d = os.path.join(dst, rel) if rel else dst
+            entries = self.mlsd(d)
+            self.known_dirs.add(d)
+            for name, facts in entries:
+                path = os.path.join(rel, name)
+                kind = facts.get('type', '').lower()
+                if kind == 'dir':
+                    pending.append(path)
+                elif kind == 'file':
+                    try:
+                        size = int(facts.get('size', 0))
+                        mtime = calendar.timegm(time.strptime(facts['modify'][:14], "%Y%m%d%H%M%S"))
+                    except (KeyError, ValueError):
+                        size, mtime = None, None
+                    inventory[path] = (size, mtime)
+        return inventory
+
     def get_storage_space(self, dst):
         """Disk space (avail, total) in GB."""
         return (None, None)             # unknown
@@ -207,8 +476,61 @@ class FtpShifter(object):
         except ftplib.all_errors as e:
             raise ShifterError(str(e))
 
-class SftpShifter(object):
+class SftpRemovals(object):
+    """Replies to pipelined SFTP remove requests, collected as paramiko delivers them."""
+    def __init__(self, sftp_client):
+        self.sftp_client = sftp_client
+        self.pending = {}               # indexed by request number, of path
+        self.errors = []                # of ShifterError
+
+    def _async_response(self, t, msg, num):
+        dst = self.pending.pop(num)
+        try:
+            if t != paramiko.sftp.CMD_STATUS:
+                raise paramiko.SFTPError("Expected status")
+            self.sftp_client._convert_status(msg)
+        except (paramiko.SFTPError,IOError) as e:
+            self.errors.append(ShifterError("%s: %s" % (dst, str(e))))
+
+class SftpReads(object):
+    """Replies to pipelined SFTP requests for reading whole files, collected as paramiko delivers them."""
+    def __init__(self, sftp_client):
+        self.sftp_client = sftp_client
+        self.pending = {}               # indexed by request number, of (command, src, offset)
+        self.sizes = {}                 # indexed by src
+        self.handles = {}               # indexed by src
+        self.chunks = {}                # indexed by src, of dict of data indexed by offset
+        self.errors = []                # of ShifterError
+
+    def _async_response(self, t, msg, num):
+        command, src, offset = self.pending.pop(num)
+        try:
+            if t == paramiko.sftp.CMD_STATUS:
+                self.sftp_client._convert_status(msg)
+            if command == paramiko.sftp.CMD_STAT and t == paramiko.sftp.CMD_ATTRS:
+                self.sizes[src] = paramiko.SFTPAttributes._from_msg(msg).st_size
+            elif command == paramiko.sftp.CMD_OPEN and t == paramiko.sftp.CMD_HANDLE:
+                self.handles[src] = msg.get_binary()
+            elif command == paramiko.sftp.CMD_READ and t == paramiko.sftp.CMD_DATA:
+                self.chunks[src][offset] = msg.get_string()
+            elif command != paramiko.sftp.CMD_CLOSE or t != paramiko.sftp.CMD_STATUS:
+                raise paramiko.SFTPError("Unexpected response")
+        except EOFError:
+            # read past the end, because the file shrank
+            pass
+        except (paramiko.SFTPError,IOError) as e:
+            self.errors.append(ShifterError("%s: %s" % (src, str(e))))
+
+    def contents(self, src):
+        """Return the data read from src."""
+        chunks = self.chunks[src]
+        return "".join([chunks[offset] for offset in sorted(chunks.keys())])
+
+class SftpShifter(Shifter):
     """Use SFTP to transfer files."""
+
+    session_attrs = Shifter.session_attrs + ('transport', 'sftp_client', 'ssh_agent')
+
     def __init__(self, host, user, port = 22):
         self.host = host
         self.user = user
@@ -218,17 +540,25 @@ class SftpShifter(object):
         return "SftpShifter(host=" + self.host + ",user=" + self.user + ",port=" + str(self.port) + ")"
 
     def open(self):
-        self.ssh_agent = paramiko.Agent()
-        keys = self.ssh_agent.get_keys()
-        if len(keys) != 1:
-            raise ShifterError("Failed to get a private key from ssh-agent")
+        global paramiko
+        import paramiko
+        super(SftpShifter, self).open()
+        pkey = self.private_key()
         try:
             self.transport = paramiko.Transport((self.host, self.port))
-            self.transport.connect(username=self.user, pkey=keys[0])
+            self.transport.connect(username=self.user, pkey=pkey)
             self.sftp_client = paramiko.SFTPClient.from_transport(self.transport)
         except paramiko.SSHException as e:
             raise ShifterError(str(e))
 
+    def private_key(self):
+        """Return the key to authenticate with, which must be the only one in ssh-agent."""
+        self.ssh_agent = paramiko.Agent()
+        keys = self.ssh_agent.get_keys()
+        if len(keys) != 1:
+            raise ShifterError("Failed to get a private key from ssh-agent")
+        return keys[0]
+
     def path_exists(self, dst):
         try:
             s = self.sftp_client.stat(dst)
@@ -236,7 +566,14 @@ class SftpShifter(object):
         except (paramiko.SFTPError,IOError) as e:
             return False
 
-    def makedirs(self, dst):
+    def getmtime(self, dst):
+        """Return modification time of dst, or None if missing."""
+        try:
+            return self.sftp_client.stat(dst).st_mtime
+        except (paramiko.SFTPError,IOError) as e:
+            return None
+
+    def makedirs_uncached(self, dst):
         if self.path_exists(dst):
             pass
         else:
@@ -248,6 +585,17 @@ class SftpShifter(object):
             except (paramiko.SFTPError,IOError) as e:
                 raise ShifterError(str(e))
 
+    def makedirs_all(self, dsts):
+        """Ensure all directories in dsts exist, trying mkdir before checking for existence."""
+        for dst in sorted(dsts):
+            if dst not in self.known_dirs:
+                try:
+                    self.sftp_client.mkdir(dst)
+                    self.known_dirs.add(dst)
+                except (paramiko.SFTPError,IOError):
+                    # exists already, or parent is missing
+                    self.makedirs(dst)
+
     def uploadfile(self, src, dst):
         try:
             self.sftp_client.put(src, dst)
@@ -265,13 +613,75 @@ class SftpShifter(object):
             raise ShifterError(str(e))
         return lines
 
+    def readlines_many(self, srcs):
+        """Return dict of lines for each file in srcs, indexed by src, keeping requests in flight for many files at once.
+Files are statted and opened, read, then closed, each step pipelined, so a window of files costs about three round trips."""
+        contents = {}
+        for i in range(0, len(srcs), SFTP_READ_WINDOW):
+            window = srcs[i:i + SFTP_READ_WINDOW]
+            reads = SftpReads(self.sftp_client)
+            try:
+                opens = []
+                for src in window:
+                    path = self.sftp_client._adjust_cwd(src)
+                    opens.append((paramiko.sftp.CMD_STAT, src, 0, path))
+                    opens.append((paramiko.sftp.CMD_OPEN, src, 0, path, paramiko.sftp.SFTP_FLAG_READ, paramiko.SFTPAttributes()))
+                self.pipeline(reads, opens)
+                if not reads.errors:
+                    requests = []
+                    for src in window:
+                        reads.chunks[src] = {}
+                        for offset in range(0, reads.sizes[src], paramiko.SFTPFile.MAX_REQUEST_SIZE):
+                            requests.append((paramiko.sftp.CMD_READ, src, offset, reads.handles[src], long(offset), paramiko.SFTPFile.MAX_REQUEST_SIZE))
+                    self.pipeline(reads, requests)
+            finally:
+                self.pipeline(reads, [(paramiko.sftp.CMD_CLOSE, src, 0, handle) for src, handle in reads.handles.items()])
+            if reads.errors:
+                raise reads.errors[0]
+            for src in window:
+                lines = reads.contents(src).split('\n')
+                if lines[-1] == '':
+                    lines.pop()
+                contents[src] = lines
+        return contents
+
+    def pipeline(self, replies, requests):
+        """Send each request of (command, src, offset, args...) without waiting for replies, which are collected by replies."""
+        try:
+            for request in requests:
+                while len(replies.pending) >= SFTP_PIPELINE_WINDOW:
+                    self.sftp_client._read_response()
+                num = self.sftp_client._async_request(replies, request[0], *request[3:])
+                replies.pending[num] = request[:3]
+            while replies.pending:
+                self.sftp_client._read_response()
+        except (paramiko.SSHException,IOError) as e:
+            raise ShifterError(str(e))
+
     def removefile(self, dst):
         try:
             self.sftp_client.remove(dst)
         except (paramiko.SFTPError,IOError) as e:
             raise ShifterError(str(e))
 
+    def removefiles(self, dsts):
+        """Remove all files in dsts, returning a list of ShifterError for any which failed.
+Requests are pipelined, so a batch costs little more than one round trip."""
+        removals = SftpRemovals(self.sftp_client)
+        try:
+            for dst in dsts:
+                while len(removals.pending) >= SFTP_PIPELINE_WINDOW:
+                    self.sftp_client._read_response()
+                num = self.sftp_client._async_request(removals, paramiko.sftp.CMD_REMOVE, self.sftp_client._adjust_cwd(dst))
+                removals.pending[num] = dst
+            while removals.pending:
+                self.sftp_client._read_response()
+        except (paramiko.SSHException,IOError) as e:
+            raise ShifterError(str(e))
+        return removals.errors
+
     def removedir_if_empty(self, dst):
+        self.known_dirs.discard(dst)
         try:
             self.sftp_client.rmdir(dst)
         except (paramiko.SFTPError,IOError) as e:
@@ -284,8 +694,29 @@ class SftpShifter(object):
             files = self.sftp_client.listdir(dst)
         except (paramiko.SFTPError,IOError) as e:
              raise ShifterError(str(e))
+        self.known_dirs.add(dst)
         return files
 
+    def walk_stat(self, dst):
+        """Return dict of (size, mtime) for all files below dst, indexed by path relative to dst."""
+        inventory = {}
+        pending = ['']
+        while pending:
+            rel = pending.pop()
+            d = os.path.join(dst, rel) if rel else dst
+            try:
+                attrs = self.sftp_client.listdir_attr(d)
+            except (paramiko.SFTPError,IOError) as e:
+                raise ShifterError(str(e))
+            self.known_dirs.add(d)
+            for a in attrs:
+                path = os.path.join(rel, a.filename)
+                if stat.S_ISDIR(a.st_mode):
+                    pending.append(path)
+                elif stat.S_ISREG(a.st_mode):
+                    inventory[path] = (a.st_size, a.st_mtime)
+        return inventory
+
     def get_storage_space(self, dst):
         """Disk space (avail, total) in GB."""
         return (None, None)             # unknown
@@ -296,11 +727,14 @@ class SftpShifter(object):
     def close(self):
         self.transport.close()
 
+SHELL_SAFE = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789@%+=:,./-_")
+
 def quote(x):
-    if " " in x:
-        return "'%s'" % x
-    else:
+    """Quote x for the device shell, if required."""
+    if x != "" and all(c in SHELL_SAFE for c in x):
         return x
+    else:
+        return "'%s'" % x.replace("'", "'\\''")
 
 def quote_all(xs):
     return [quote(x) for x in xs]
@@ -322,8 +756,83 @@ def adb(commands, serial = None):
     except OSError as e:
         raise ShifterError("adb %s" % str(e))
 
-class AdbShifter(object):
+class AdbShell(object):
+    """A long-lived adb shell, which runs one command at a time.
+
+The output of each command is terminated by a sentinel line carrying
+its exit status.  Standard error is merged into standard output.
+"""
+    def __init__(self, serial = None):
+        if serial:
+            command = ["adb", "-s", serial, "shell", "sh"]
+        else:
+            command = ["adb", "shell", "sh"]
+        print("%s" % ' '.join(command))
+        self.sentinel = "qlsync-%016x:" % random.getrandbits(64)
+        try:
+            self.process = subprocess.Popen(command, stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+        except OSError as e:
+            raise ShifterError("adb %s" % str(e))
+        # older adb gives the shell a pty, so stop it echoing our commands,
+        # and discard anything before the first sentinel
+        self.send("stty -echo 2>/dev/null")
+        self.receive()
+
+    def send(self, command):
+        try:
+            self.process.stdin.write("%s 2>&1; printf '\\n%s%%d\\n' $?\n" % (command, self.sentinel))
+            self.process.stdin.flush()
+        except IOError as e:
+            raise ShifterError("adb shell %s" % str(e))
+
+    def receive(self):
+        """Return (rc, lines) for the last command sent."""
+        lines = []
+        while True:
+            line = self.process.stdout.readline()
+            if line == "":
+                raise ShifterError("adb shell exited unexpectedly")
+            line = line.rstrip('\r\n')
+            if line.startswith(self.sentinel):
+                rc = int(line[len(self.sentinel):])
+                break
+            lines.append(line)
+        # the sentinel is preceded by a newline, in case the output lacked one
+        if lines and lines[-1] == "":
+            lines.pop()
+        return (rc, lines)
+
+    def run(self, commands):
+        """Run shell command, return (rc, stdout, stderr) like adb()."""
+        self.send(' '.join(quote_all(commands)))
+        (rc, lines) = self.receive()
+        print("adb shell %s -> %d" % (' '.join(commands), rc))
+        if rc == 0:
+            return (rc, lines, [])
+        else:
+            return (rc, lines, lines)
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.process.wait()
+
+class AdbShifter(Shifter):
     """Use ADB to transfer files."""
+
+    # run shell commands over a single long-lived adb shell, rather
+    # than one adb process per command
+    persistent_shell = True
+
+    shell = None
+
+    session_attrs = Shifter.session_attrs + ('shell',)
+
+    # each adb push has a connection setup cost, so push many files at once
+    upload_batch_size = 32
+
     def __init__(self, sdcardroot, serial):
         print("AdbShifter::__init__(%s, %s)" % (sdcardroot, serial))
         self.sdcardroot = sdcardroot
@@ -335,60 +844,183 @@ class AdbShifter(object):
     def adb(self, commands):
         return adb(commands, self.serial)
 
+    def adb_shell(self, commands):
+        """Run shell command on the device, return (rc, stdout, stderr)."""
+        if self.shell is not None:
+            return self.shell.run(commands)
+        else:
+            return self.adb(["shell"] + quote_all(commands))
+
     def open(self):
         """Confirm the device is there."""
         print("AdbShifter::open()")
-        (rc, stdout_lines, stderr_lines) = self.adb(["shell", "echo"])
+        super(AdbShifter, self).open()
+        self.shell = None
+        if self.persistent_shell:
+            self.shell = AdbShell(self.serial)
+        (rc, stdout_lines, stderr_lines) = self.adb_shell(["echo"])
         if rc != 0:
+            # callers don't close a shifter which failed to open
+            self.close()
             raise ShifterError(", ".join(stderr_lines))
 
     def path_exists(self, dst):
-        (rc, stdout_lines, stderr_lines) = self.adb(["shell", "ls", "-d", dst])
+        (rc, stdout_lines, stderr_lines) = self.adb_shell(["ls", "-d", dst])
         return rc == 0 and stdout_lines and stdout_lines[0] == dst
 
-    def makedirs(self, dst):
-        if self.path_exists(dst):
-            pass
-        else:
-            (rc, stdout_lines, stderr_lines) = self.adb(["shell", "mkdir", "-p", dst])
+    def getmtime(self, dst):
+        """Return modification time of dst, or None if missing."""
+        return self.getmtimes([dst])[0]
+
+    def getmtimes(self, dsts):
+        """Return list of modification times for dsts, with None for any which are missing, with a single stat for all."""
+        script = 'for f; do stat -c %Y "$f" 2>/dev/null || echo -; done'
+        (rc, stdout_lines, stderr_lines) = self.adb_shell(["sh", "-c", script, "sh"] + dsts)
+        if rc != 0 or len(stdout_lines) != len(dsts):
+            raise ShifterError(", ".join(stderr_lines))
+        mtimes = []
+        for line in stdout_lines:
+            try:
+                mtimes.append(int(line))
+            except ValueError:
+                mtimes.append(None)
+        return mtimes
+
+    def makedirs_uncached(self, dst):
+        # mkdir -p is happy if dst exists, so don't bother checking first
+        (rc, stdout_lines, stderr_lines) = self.adb_shell(["mkdir", "-p", dst])
+        if rc != 0:
+            raise ShifterError(", ".join(stderr_lines))
+
+    def makedirs_all(self, dsts):
+        """Ensure all directories in dsts exist, with a single mkdir -p for many."""
+        missing = [dst for dst in sorted(dsts) if dst not in self.known_dirs]
+        for i in range(0, len(missing), ADB_MAX_ARGS):
+            batch = missing[i:i + ADB_MAX_ARGS]
+            (rc, stdout_lines, stderr_lines) = self.adb_shell(["mkdir", "-p"] + batch)
             if rc != 0:
                 raise ShifterError(", ".join(stderr_lines))
+            for dst in batch:
+                self.known_dirs.add(dst)
 
     def uploadfile(self, src, dst):
         (rc, stdout_lines, stderr_lines) = self.adb(["push", src, dst])
         if rc != 0:
             raise ShifterError(", ".join(stderr_lines))
 
+    def uploadfiles(self, copies):
+        """Upload list of (src,dst), with one push for all files going into the same directory under the same name."""
+        by_dir = {}
+        singles = []
+        for src, dst in copies:
+            if os.path.basename(src) == os.path.basename(dst):
+                by_dir.setdefault(os.path.dirname(dst), []).append(src)
+            else:
+                singles.append((src, dst))
+        for dst_dir in sorted(by_dir.keys()):
+            srcs = by_dir[dst_dir]
+            if len(srcs) == 1:
+                self.uploadfile(srcs[0], os.path.join(dst_dir, os.path.basename(srcs[0])))
+            else:
+                (rc, stdout_lines, stderr_lines) = self.adb(["push"] + srcs + [dst_dir + "/"])
+                if rc != 0:
+                    raise ShifterError(", ".join(stderr_lines))
+        for src, dst in singles:
+            self.uploadfile(src, dst)
+
     def readlines(self, dst):
-        (rc, stdout_lines, stderr_lines) = self.adb(["shell", "cat", dst])
+        (rc, stdout_lines, stderr_lines) = self.adb_shell(["cat", dst])
         if rc != 0:
             raise ShifterError(", ".join(stderr_lines))
         print("readlines %s\n%s" % (dst, '\n'.join(stdout_lines)))
         return stdout_lines
 
+    def readlines_many(self, srcs):
+        """Return dict of lines for each file in srcs, indexed by src, with a single cat for many."""
+        contents = {}
+        sentinel = "qlsync-%016x:" % random.getrandbits(64)
+        # as for AdbShell, each file is followed by a newline and a sentinel line with its exit status
+        script = 'for f; do cat "$f"; printf \'\\n%s%%d\\n\' $?; done' % sentinel
+        for i in range(0, len(srcs), ADB_MAX_ARGS):
+            batch = srcs[i:i + ADB_MAX_ARGS]
+            (rc, stdout_lines, stderr_lines) = self.adb_shell(["sh", "-c", script, "sh"] + batch)
+            lines = []
+            pending = list(batch)
+            for line in stdout_lines:
+                if line.startswith(sentinel):
+                    src = pending.pop(0)
+                    if line[len(sentinel):] != "0":
+                        raise ShifterError("cat %s: %s" % (src, ", ".join([l for l in lines + stderr_lines if l != ""])))
+                    if lines and lines[-1] == "":
+                        lines.pop()
+                    contents[src] = lines
+                    lines = []
+                else:
+                    lines.append(line)
+            if pending:
+                raise ShifterError(", ".join(stderr_lines) or "failed to read %s" % pending[0])
+        return contents
+
     def removefile(self, dst):
-        (rc, stdout_lines, stderr_lines) = self.adb(["shell", "rm", dst])
+        (rc, stdout_lines, stderr_lines) = self.adb_shell(["rm", dst])
         if rc != 0:
             raise ShifterError(", ".join(stderr_lines))
 
+    def removefiles(self, dsts):
+        """Remove all files in dsts, with a single rm for many."""
+        errors = []
+        for i in range(0, len(dsts), ADB_MAX_ARGS):
+            (rc, stdout_lines, stderr_lines) = self.adb_shell(["rm", "-f"] + dsts[i:i + ADB_MAX_ARGS])
+            if rc != 0:
+                errors.append(ShifterError(", ".join(stderr_lines)))
+        return errors
+
     def removedir_if_empty(self, dst):
-        (rc, stdout_lines, stderr_lines) = self.adb(["shell", "rmdir", dst])
+        self.known_dirs.discard(dst)
+        (rc, stdout_lines, stderr_lines) = self.adb_shell(["rmdir", dst])
         # ignore all errors, since this fails if not empty and we don't care
 
+    def removedirs_if_empty(self, dsts):
+        """Remove whichever directories in dsts are empty, deepest first, with a single rmdir for many."""
+        dsts = sorted(dsts, reverse = True)
+        for dst in dsts:
+            self.known_dirs.discard(dst)
+        for i in range(0, len(dsts), ADB_MAX_ARGS):
+            (rc, stdout_lines, stderr_lines) = self.adb_shell(["rmdir"] + dsts[i:i + ADB_MAX_ARGS])
+            # ignore all errors, since this fails if not empty and we don't care
+
     def ls(self, dst):
         """Return directory listing."""
-        (rc, stdout_lines, stderr_lines) = self.adb(["shell", "ls", dst])
+        (rc, stdout_lines, stderr_lines) = self.adb_shell(["ls", dst])
         if rc != 0:
             raise ShifterError(", ".join(stderr_lines))
+        self.known_dirs.add(dst)
         print("ls %s\n%s" % (dst, '\n'.join(stdout_lines)))
         return stdout_lines
 
+    def walk_stat(self, dst):
+        """Return dict of (size, mtime) for all files below dst, indexed by path relative to dst."""
+        (rc, stdout_lines, stderr_lines) = self.adb_shell(["find", dst, "-type", "f", "-exec", "stat", "-c", "%s %Y %n", "{}", "+"])
+        if rc != 0:
+            raise ShifterError(", ".join(stderr_lines))
+        prefix = dst.rstrip("/") + "/"
+        inventory = {}
+        for line in stdout_lines:
+            fields = line.split(" ", 2)
+            if len(fields) == 3 and fields[2].startswith(prefix):
+                try:
+                    inventory[fields[2][len(prefix):]] = (int(fields[0]), int(fields[1]))
+                except ValueError:
+                    continue
+                self.known_dirs.add(os.path.dirname(fields[2]))
+        return inventory
+
     def get_storage_space(self, dst):
         """Disk space (avail, total) in GB."""
         # Example Android df output:
         # Filesystem             Size   Used   Free   Blksize
         # /storage/sdcard0         9G     4G     5G   65536
-        (rc, stdout_lines, stderr_lines) = self.adb(["shell", "df", dst])
+        (rc, stdout_lines, stderr_lines) = self.adb_shell(["df", dst])
         if rc == 0 and len(stdout_lines) >= 2:
             fields = stdout_lines[1].split()
             return (parse_as_gigabytes(fields[3]), parse_as_gigabytes(fields[1]))
@@ -398,10 +1030,349 @@ class AdbShifter(object):
     def flush(self):
         """Trigger a rescan of the sdcard."""
         print("AdbShifter::flush()")
-        (rc, stdout_lines, stderr_lines) = self.adb(["shell", "am", "broadcast", "-a", "android.intent.action.MEDIA_MOUNTED", "-d", "file://%s" % self.sdcardroot])
+        (rc, stdout_lines, stderr_lines) = self.adb_shell(["am", "broadcast", "-a", "android.intent.action.MEDIA_MOUNTED", "-d", "file://%s" % self.sdcardroot])
         if rc != 0:
             raise ShifterError(", ".join(stderr_lines))
 
     def close(self):
         print("AdbShifter::close()")
-        pass
+        if self.shell is not None:
+            self.shell.close()
+            self.shell = None
+
+class MemoryDevice(object):
+    """A simulated device, whose files are kept in memory and shared by all MemoryShifter sessions on it.
+
+Time is simulated too: each session has a clock advanced by the cost of
+its calls, and the device clock is the latest of them, so sessions in
+parallel overlap.  Modification times are a count of changes, so every
+change is visible to anything comparing them.
+"""
+
+    # contents of larger files are not kept, only their size
+    MAX_CONTENTS = 1024 * 1024
+
+    def __init__(self, capacity = 16 * GIGA):
+        self.capacity = capacity
+        self.files = {}                  # indexed by path, of (size, mtime, contents or None)
+        self.dirs = {"/": 0}             # indexed by path, of mtime
+        self.entries = {"/": set()}      # indexed by directory path, of set of names within
+        self.generation = 0
+        self.clock = 0.0
+        self.calls = {}                  # indexed by method, of number of calls
+        self.round_trips = 0
+        self.bytes = 0
+        self.sessions = 0
+        self.max_sessions = 0            # most ever open at once
+        self.lock = threading.Lock()
+
+    def stats(self):
+        """Return call counts, round trips, bytes moved and simulated elapsed time."""
+        with self.lock:
+            return {
+                "calls": dict(self.calls),
+                "round_trips": self.round_trips,
+                "bytes": self.bytes,
+                "elapsed": self.clock,
+                "max_sessions": self.max_sessions,
+            }
+
+    def used(self):
+        return sum([size for size, mtime, contents in self.files.values()])
+
+    def touch(self, path):
+        """Bump the mtime of directory path, whose entries have changed.  Call with lock held."""
+        self.generation += 1
+        self.dirs[path] = self.generation
+
+    def mkdir(self, path):
+        """Create directory path and any missing parents.  Call with lock held."""
+        if path in self.dirs:
+            return
+        if path in self.files:
+            raise ShifterError("%s is a file" % path)
+        parent = os.path.dirname(path)
+        self.mkdir(parent)
+        self.entries[parent].add(os.path.basename(path))
+        self.touch(parent)
+        self.entries[path] = set()
+        self.touch(path)
+
+    def write(self, path, size, contents):
+        """Create or replace file path.  Call with lock held."""
+        parent = os.path.dirname(path)
+        if parent not in self.dirs:
+            raise ShifterError("no such directory %s" % parent)
+        if path in self.dirs:
+            raise ShifterError("%s is a directory" % path)
+        self.generation += 1
+        self.files[path] = (size, self.generation, contents)
+        if os.path.basename(path) not in self.entries[parent]:
+            self.entries[parent].add(os.path.basename(path))
+            self.touch(parent)
+
+    def remove(self, path):
+        """Remove file path.  Call with lock held."""
+        if path not in self.files:
+            raise ShifterError("no such file %s" % path)
+        del self.files[path]
+        parent = os.path.dirname(path)
+        self.entries[parent].discard(os.path.basename(path))
+        self.touch(parent)
+
+    def rmdir_if_empty(self, path):
+        """Remove directory path if it is empty.  Call with lock held."""
+        if path == "/" or path not in self.dirs or self.entries[path]:
+            return
+        del self.dirs[path]
+        del self.entries[path]
+        parent = os.path.dirname(path)
+        self.entries[parent].discard(os.path.basename(path))
+        self.touch(parent)
+
+class MemoryShifter(Shifter):
+    """Transfer files to a simulated in-memory device, for deterministic performance testing.
+
+Each call costs a round trip of latency seconds, plus bytes moved over
+bandwidth (bytes per second, None for unlimited); opening a session
+costs open_latency.  If batching, batch operations cost a single round
+trip, otherwise they fall back on one call per item.  At most
+max_sessions may be open at once.  If fail is given, it is called with
+(method, path) before each call, and the call fails if it returns true.
+If realtime, the simulated time is actually slept as well.
+
+Copies of a MemoryShifter share the device, so may be used for extra
+connections, and device.stats() gives the totals.
+"""
+
+    read_ahead = False
+
+    def __init__(self, device = None, latency = 0.0, bandwidth = None, open_latency = None,
+                 batching = True, max_sessions = None, fail = None, realtime = False):
+        if device is None:
+            device = MemoryDevice()
+        self.device = device
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.open_latency = latency if open_latency is None else open_latency
+        self.batching = batching
+        self.max_sessions = max_sessions
+        self.fail = fail
+        self.realtime = realtime
+        self.upload_batch_size = 32 if batching else 1
+        self.clock = 0.0
+
+    def __str__(self):
+        return "MemoryShifter(latency=%g,bandwidth=%s,batching=%s)" % (self.latency, self.bandwidth, self.batching)
+
+    def call(self, method, path = None, nbytes = 0, round_trips = 1, latency = None):
+        """Account for a call, failing it if required."""
+        if latency is None:
+            latency = self.latency
+        cost = round_trips * latency
+        if self.bandwidth:
+            cost += nbytes * 1.0 / self.bandwidth
+        with self.device.lock:
+            self.device.calls[method] = self.device.calls.get(method, 0) + 1
+            self.device.round_trips += round_trips
+            self.device.bytes += nbytes
+            self.clock += cost
+            self.device.clock = max(self.device.clock, self.clock)
+        if self.realtime and cost > 0:
+            time.sleep(cost)
+        if self.fail is not None and self.fail(method, path):
+            if isinstance(path, list):
+                path = "%s and %d more" % (path[0], len(path) - 1) if path else ""
+            raise ShifterError("injected failure in %s %s" % (method, path))
+
+    def open(self):
+        with self.device.lock:
+            if self.max_sessions is not None and self.device.sessions >= self.max_sessions:
+                raise ShifterError("too many sessions")
+            self.device.sessions += 1
+            self.device.max_sessions = max(self.device.max_sessions, self.device.sessions)
+            self.clock = self.device.clock
+        super(MemoryShifter, self).open()
+        try:
+            self.call("open", latency = self.open_latency)
+        except:
+            # the session never opened, so give back its slot
+            with self.device.lock:
+                self.device.sessions -= 1
+            raise
+
+    def path_exists(self, dst):
+        dst = memory_path(dst)
+        self.call("path_exists", dst)
+        return dst in self.device.files or dst in self.device.dirs
+
+    def mtime(self, dst):
+        if dst in self.device.files:
+            return self.device.files[dst][1]
+        return self.device.dirs.get(dst)
+
+    def getmtime(self, dst):
+        dst = memory_path(dst)
+        self.call("getmtime", dst)
+        return self.mtime(dst)
+
+    def getmtimes(self, dsts):
+        if not self.batching:
+            return super(MemoryShifter, self).getmtimes(dsts)
+        dsts = [memory_path(dst) for dst in dsts]
+        self.call("getmtimes", dsts)
+        return [self.mtime(dst) for dst in dsts]
+
+    def makedirs_uncached(self, dst):
+        dst = memory_path(dst)
+        self.call("makedirs", dst)
+        with self.device.lock:
+            self.device.mkdir(dst)
+
+    def makedirs_all(self, dsts):
+        if not self.batching:
+            return super(MemoryShifter, self).makedirs_all(dsts)
+        dsts = [dst for dst in dsts if dst not in self.known_dirs]
+        if not dsts:
+            return
+        self.call("makedirs_all", dsts)
+        with self.device.lock:
+            for dst in dsts:
+                self.device.mkdir(memory_path(dst))
+        for dst in dsts:
+            self.known_dirs.add(dst)
+
+    def read_source(self, src):
+        try:
+            size = os.path.getsize(src)
+            contents = None
+            if size <= MemoryDevice.MAX_CONTENTS:
+                with open(src, 'rb') as f:
+                    contents = f.read()
+        except (IOError, OSError) as e:
+            raise ShifterError(str(e))
+        return (size, contents)
+
+    def uploadfile(self, src, dst):
+        dst = memory_path(dst)
+        size, contents = self.read_source(src)
+        self.call("uploadfile", dst, size)
+        with self.device.lock:
+            self.device.write(dst, size, contents)
+
+    def uploadfiles(self, copies):
+        if not self.batching:
+            return super(MemoryShifter, self).uploadfiles(copies)
+        sources = [self.read_source(src) for src, dst in copies]
+        dsts = [memory_path(dst) for src, dst in copies]
+        self.call("uploadfiles", dsts, sum([size for size, contents in sources]))
+        with self.device.lock:
+            for dst, (size, contents) in zip(dsts, sources):
+                self.device.write(dst, size, contents)
+
+    def lines(self, src):
+        if src not in self.device.files:
+            raise ShifterError("no such file %s" % src)
+        size, mtime, contents = self.device.files[src]
+        if contents is None:
+            raise ShifterError("contents of %s not kept" % src)
+        return contents.split("\n")[:-1] if contents.endswith("\n") else contents.split("\n")
+
+    def readlines(self, src):
+        src = memory_path(src)
+        self.call("readlines", src, self.device.files.get(src, (0,))[0])
+        return self.lines(src)
+
+    def readlines_many(self, srcs):
+        if not self.batching:
+            return super(MemoryShifter, self).readlines_many(srcs)
+        paths = [memory_path(src) for src in srcs]
+        self.call("readlines_many", paths, sum([self.device.files.get(path, (0,))[0] for path in paths]))
+        contents = {}
+        for src, path in zip(srcs, paths):
+            contents[src] = self.lines(path)
+        return contents
+
+    def removefile(self, dst):
+        dst = memory_path(dst)
+        self.call("removefile", dst)
+        with self.device.lock:
+            self.device.remove(dst)
+
+    def removefiles(self, dsts):
+        if not self.batching:
+            return super(MemoryShifter, self).removefiles(dsts)
+        self.call("removefiles", dsts)
+        errors = []
+        with self.device.lock:
+            for dst in dsts:
+                try:
+                    self.device.remove(memory_path(dst))
+                except ShifterError as e:
+                    errors.append(e)
+        return errors
+
+    def removedir_if_empty(self, dst):
+        self.known_dirs.discard(dst)
+        dst = memory_path(dst)
+        self.call("removedir_if_empty", dst)
+        with self.device.lock:
+            self.device.rmdir_if_empty(dst)
+
+    def removedirs_if_empty(self, dsts):
+        if not self.batching:
+            return super(MemoryShifter, self).removedirs_if_empty(dsts)
+        self.call("removedirs_if_empty", dsts)
+        with self.device.lock:
+            for dst in sorted(dsts, reverse = True):
+                self.known_dirs.discard(dst)
+                self.device.rmdir_if_empty(memory_path(dst))
+
+    def ls(self, dst):
+        """Return directory listing."""
+        path = memory_path(dst)
+        self.call("ls", path)
+        with self.device.lock:
+            if path not in self.device.entries:
+                raise ShifterError("no such directory %s" % path)
+            files = list(self.device.entries[path])
+        self.known_dirs.add(dst)
+        return files
+
+    def walk_stat(self, dst):
+        """Return dict of (size, mtime) for all files below dst, indexed by path relative to dst."""
+        root = memory_path(dst)
+        self.call("walk_stat", root)
+        inventory = {}
+        with self.device.lock:
+            if root not in self.device.dirs:
+                raise ShifterError("no such directory %s" % root)
+            prefix = root.rstrip("/") + "/"
+            for path, (size, mtime, contents) in self.device.files.items():
+                if path.startswith(prefix):
+                    inventory[path[len(prefix):]] = (size, mtime)
+            for path in self.device.dirs:
+                if path == root or path.startswith(prefix):
+                    self.known_dirs.add(path)
+        return inventory
+
+    def get_storage_space(self, dst):
+        """Disk space (avail, total) in GB."""
+        self.call("get_storage_space", dst)
+        with self.device.lock:
+            return ((self.device.capacity - self.device.used()) * 1.0 / GIGA, self.device.capacity * 1.0 / GIGA)
+
+    def flush(self):
+        self.call("flush")
+
+    def close(self):
+        with self.device.lock:
+            self.device.calls["close"] = self.device.calls.get("close", 0) + 1
+            self.device.sessions -= 1
+
+def memory_path(path):
+    """Return path normalised as absolute, for a MemoryDevice."""
+    path = "/" + os.path.normpath(path).lstrip("/")
+    if path == "/.":
+        return "/"
+    return path
@@ -0,0 +1,221 @@
+# Copyright 2012 Simon Guest
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+
+import gzip
+import json
+import os
+import os.path
+import threading
+import time
+import urllib
+
+from qlsync.shifters import ShifterError
+
+# if set in the environment, scans and syncs are traced into this directory
+TRACE_DIR_ENV = "QLSYNC_TRACE_DIR"
+
+TRACE_MAGIC = "qlsync-trace 1"
+
+# paths may be in any encoding, so strings go through JSON as latin-1, which maps every byte
+ENCODING = "latin-1"
+
+def encode(x):
+    """Return x as something JSON can hold."""
+    if isinstance(x, (list, tuple)):
+        return [encode(y) for y in x]
+    elif isinstance(x, (set, frozenset)):
+        return [encode(y) for y in sorted(x)]
+    elif isinstance(x, dict):
+        return dict([(k, encode(v)) for k, v in x.items()])
+    elif isinstance(x, ShifterError):
+        return {"error": x.message}
+    return x
+
+def decode(x):
+    """Undo the string conversion of JSON, so strings are the bytes they were."""
+    if isinstance(x, unicode):
+        return x.encode(ENCODING)
+    elif isinstance(x, list):
+        return [decode(y) for y in x]
+    elif isinstance(x, dict):
+        return dict([(decode(k), decode(v)) for k, v in x.items()])
+    return x
+
+def upload_sizes(method, args):
+    """Return sizes of the local sources of an upload call, or None if it isn't one."""
+    if method == 'uploadfile':
+        srcs = [args[0]]
+    elif method == 'uploadfiles':
+        srcs = [src for src, dst in args[0]]
+    else:
+        return None
+    sizes = []
+    for src in srcs:
+        try:
+            sizes.append(os.path.getsize(src))
+        except OSError:
+            sizes.append(None)
+    return sizes
+
+class TraceRecorder(object):
+    """Write every shifter call, with arguments, result and timing, to a gzipped JSON lines trace file."""
+
+    def __init__(self, path, header):
+        self.path = path
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.n_sessions = 0
+        self.f = gzip.open(path, 'wb')
+        header = dict(header)
+        header["trace"] = TRACE_MAGIC
+        header["start"] = self.start_time
+        self.write(header)
+
+    def write(self, record):
+        self.f.write(json.dumps(encode(record), encoding = ENCODING, separators = (',', ':')) + "\n")
+
+    def new_session(self):
+        with self.lock:
+            self.n_sessions += 1
+            return self.n_sessions - 1
+
+    def record(self, session, method, args, kwargs, t0, elapsed, result = None, error = None):
+        record = {"s": session, "m": method, "a": args, "t": t0 - self.start_time, "d": elapsed}
+        if kwargs:
+            record["k"] = kwargs
+        if error is not None:
+            record["e"] = str(error)
+        else:
+            record["r"] = result
+        sizes = upload_sizes(method, args)
+        if sizes is not None:
+            record["z"] = sizes
+        with self.lock:
+            if self.f is not None:
+                self.write(record)
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+            self.f = None
+
+def tracing_enabled():
+    """Return whether scans and syncs are to be traced."""
+    return bool(os.environ.get(TRACE_DIR_ENV))
+
+def trace_recorder(device_name, activity, header):
+    """Return a TraceRecorder for activity on device_name if tracing is enabled in the environment, else None."""
+    if not tracing_enabled():
+        return None
+    trace_dir = os.environ[TRACE_DIR_ENV]
+    try:
+        if not os.path.isdir(trace_dir):
+            os.makedirs(trace_dir)
+        stem = os.path.join(trace_dir, "%s-%s-%s" % (urllib.quote(device_name, safe = ""), activity, time.strftime("%Y%m%d-%H%M%S")))
+        path = stem + ".jsonl.gz"
+        n = 1
+        while os.path.exists(path):
+            path = "%s-%d.jsonl.gz" % (stem, n)
+            n += 1
+        return TraceRecorder(path, header)
+    except (IOError, OSError) as e:
+        print("trace disabled: %s" % str(e))
+        return None
+
+def read_trace(path):
+    """Return (header, list of call records) from trace file path."""
+    f = gzip.open(path, 'rb')
+    try:
+        header = decode(json.loads(f.readline()))
+        if header.get("trace") != TRACE_MAGIC:
+            raise ValueError("%s is not a qlsync trace" % path)
+        calls = [decode(json.loads(line)) for line in f if line.strip()]
+    finally:
+        f.close()
+    return (header, calls)
+
+def call_key(method, args):
+    """Return what identifies a call for replay.  Upload sources are local, so only destinations count."""
+    if method == 'uploadfile':
+        args = args[1:]
+    elif method == 'uploadfiles':
+        args = [[dst for src, dst in args[0]]]
+    return json.dumps([method, encode(args)], encoding = ENCODING)
+
+# what ReplayShifter answers for calls not in the trace
+UNRECORDED = {
+    'path_exists': False,
+    'getmtime': None,
+    'walk_stat': {},
+    'removefiles': [],
+    'get_storage_space': (None, None),
+}
+
+class ReplayShifter(object):
+    """Answer shifter calls from a trace, so scans and syncs can be rerun offline against a recorded device.
+
+Each call gets the recorded result of the next matching call in the
+trace, or the last one once they run out.  Calls not in the trace at
+all get a harmless answer and are counted as unmatched.  Copies share
+the trace, so extra connections work as usual.
+"""
+
+    upload_batch_size = 1
+    read_ahead = False
+
+    def __init__(self, calls, upload_batch_size = None):
+        self.answers = {}                # indexed by call_key, of list of records
+        self.calls = {}                  # indexed by method, of number of calls made
+        self.unmatched = {}              # indexed by method, of number of calls not in the trace
+        self.lock = threading.Lock()
+        recorded_batch = 1
+        for record in calls:
+            self.answers.setdefault(call_key(record["m"], record["a"]), []).append(record)
+            if record["m"] == 'uploadfiles':
+                recorded_batch = max(recorded_batch, len(record["a"][0]))
+        self.upload_batch_size = upload_batch_size or recorded_batch
+
+    def __str__(self):
+        return "ReplayShifter"
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        def replayed(*args):
+            return self.replay(method, args)
+        return replayed
+
+    def replay(self, method, args):
+        key = call_key(method, list(args))
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            records = self.answers.get(key)
+            if not records:
+                self.unmatched[method] = self.unmatched.get(method, 0) + 1
+                record = None
+            elif len(records) > 1:
+                record = records.pop(0)
+            else:
+                record = records[0]
+        if record is None:
+            if method == 'getmtimes':
+                return [None] * len(args[0])
+            if method in ('ls', 'readlines', 'readlines_many'):
+                raise ShifterError("%s not in trace" % method)
+            return UNRECORDED.get(method)
+        if "e" in record:
+            raise ShifterError(record["e"])
+        return restore(method, record.get("r"))
+
+def restore(method, result):
+    """Return a recorded result in the form the method returns it."""
+    if method == 'get_storage_space':
+        return tuple(result)
+    elif method == 'walk_stat':
+        return dict([(path, tuple(v)) for path, v in result.items()])
+    elif method == 'removefiles':
+        return [ShifterError(e["error"]) for e in result]
+    return result